@@ -0,0 +1,166 @@
+# benchmark of the slicing stages over examples/*.stl and generated meshes.
+#   python bench.py                                  run and print the timings
+#   python bench.py -o results.json                  save them
+#   python bench.py --baseline results.json          flag the stages slower than the saved run
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from main import load_mesh, parse_stl, TriangleIndex, sweep_segments, segments_from_array, unique_segments, surfaces_from_segments, slice_layers, mesh_levels, STL_BINARY_DTYPE
+
+def write_binary_stl(filename: str, triangles: np.ndarray):
+    edges = triangles[:, 1:] - triangles[:, :1]
+    normals = np.cross(edges[:, 0], edges[:, 1])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    facets = np.zeros(len(triangles), dtype=STL_BINARY_DTYPE)
+    facets['normal'] = normals
+    facets['vertices'] = triangles
+    with open(filename, 'wb') as file:
+        file.write(bytes(80))
+        file.write(np.uint32(len(triangles)).tobytes())
+        facets.tofile(file)
+
+# icosahedron subdivided n times, 20 * 4**n triangles on the unit sphere
+def sphere(subdivisions: int) -> np.ndarray:
+    t = (1 + 5 ** 0.5) / 2
+    vertices = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    triangles = vertices[faces]
+    triangles /= np.linalg.norm(triangles, axis=2, keepdims=True)
+    for _ in range(subdivisions):
+        a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        ab, bc, ca = [m / np.linalg.norm(m, axis=1, keepdims=True) for m in ((a + b) / 2, (b + c) / 2, (c + a) / 2)]
+        triangles = np.stack([np.stack(f, axis=1) for f in ((a, ab, ca), (ab, b, bc), (ca, bc, c), (ab, bc, ca))], axis=1).reshape(-1, 3, 3)
+    return triangles
+
+# n x n x n separate cubes of side 0.5 on a grid of pitch 1: many contours on every layer
+def lattice(n: int) -> np.ndarray:
+    corners = np.array([[x, y, z] for z in (0, 0.5) for y in (0, 0.5) for x in (0, 0.5)])
+    # outward facing triangles of a box, as indices into corners
+    faces = np.array([[0, 2, 1], [1, 2, 3], [4, 5, 6], [5, 7, 6], [0, 1, 4], [1, 5, 4], [2, 6, 3], [3, 6, 7], [0, 4, 2], [2, 4, 6], [1, 3, 5], [3, 7, 5]])
+    offsets = np.stack(np.meshgrid(np.arange(n), np.arange(n), np.arange(n), indexing='ij'), axis=-1).reshape(-1, 1, 1, 3)
+    return (corners[faces][None] + offsets).reshape(-1, 3, 3)
+
+SYNTHETIC = {"sphere-5": lambda: sphere(5), "sphere-6": lambda: sphere(6), "lattice-12": lambda: lattice(12)}
+
+# time of the fastest run, then peak memory of one more run under tracemalloc
+def measure(stage, repeat: int) -> dict:
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"time": best, "peak_mb": peak / 1e6}
+
+def benchmark(filename: str, step: float, repeat: int) -> dict:
+    mesh = load_mesh(filename)
+    triangles = len(mesh.faces)
+    levels = mesh_levels(mesh, step)
+
+    def intersect():
+        index = TriangleIndex(mesh)
+        return [unique_segments(segments_from_array(segments, mesh.normals[faces])) for _, segments, faces in sweep_segments(mesh, index, levels)]
+
+    layer_segments = intersect()
+
+    def surfaces():
+        for segments in layer_segments:
+            try:
+                surfaces_from_segments(segments)
+            except Exception:
+                pass
+
+    stages = {
+        "parse_stl": lambda: parse_stl(filename),
+        "load_mesh": lambda: load_mesh(filename),
+        "intersect": intersect,
+        "surfaces": surfaces,
+        "pipeline": lambda: list(slice_layers(load_mesh(filename), step)),
+    }
+    results = {"triangles": triangles, "layers": len(levels), "stages": {}}
+    for name, stage in stages.items():
+        result = measure(stage, repeat)
+        result["triangles_per_s"] = triangles / max(result["time"], 1e-9)
+        result["layers_per_s"] = len(levels) / max(result["time"], 1e-9)
+        results["stages"][name] = result
+    return results
+
+# the stages at least threshold slower than in baseline, as (model, stage, ratio). Stages that lost less than
+# min_time seconds are ignored, the timings of the smallest models are mostly noise
+def compare(results: dict, baseline: dict, threshold: float = 0.2, min_time: float = 0.005) -> list[tuple[str, str, float]]:
+    regressions = []
+    for model, result in results["models"].items():
+        previous = baseline["models"].get(model)
+        if previous is None: continue
+        for stage, timing in result["stages"].items():
+            if stage not in previous["stages"]: continue
+            before = previous["stages"][stage]["time"]
+            ratio = timing["time"] / max(before, 1e-9)
+            if ratio > 1 + threshold and timing["time"] - before > min_time:
+                regressions.append((model, stage, ratio))
+    return regressions
+
+# the report of each model is written to output as soon as it is measured
+def run(files: list[str], synthetic: list[str], step: float, repeat: int, output=sys.stdout) -> dict:
+    results = {"python": platform.python_version(), "numpy": np.__version__, "step": step, "models": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = [(os.path.basename(f), f) for f in files]
+        for name in synthetic:
+            filename = os.path.join(tmp, name + ".stl")
+            write_binary_stl(filename, SYNTHETIC[name]())
+            inputs.append((name, filename))
+        for name, filename in inputs:
+            results["models"][name] = benchmark(filename, step, repeat)
+            print(report(name, results["models"][name]), file=output, flush=True)
+    return results
+
+def report(name: str, result: dict) -> str:
+    lines = ["{} ({} triangles, {} layers)".format(name, result["triangles"], result["layers"])]
+    for stage, timing in result["stages"].items():
+        lines.append("  {:<10} {:>9.4f}s {:>9.1f} MB {:>12.0f} triangles/s {:>9.0f} layers/s".format(stage, timing["time"], timing["peak_mb"], timing["triangles_per_s"], timing["layers_per_s"]))
+    return "\n".join(lines)
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the slicing stages")
+    parser.add_argument("files", nargs="*", help="STL files (default: examples/*.stl)")
+    parser.add_argument("--synthetic", nargs="*", choices=sorted(SYNTHETIC), default=sorted(SYNTHETIC), help="generated meshes to add (default: all)")
+    parser.add_argument("--step", type=float, default=0.05, help="layer height (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is kept (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results saved in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression (default: %(default)s)")
+    return parser.parse_args(argv)
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    # invalid layers are expected on some examples, their warnings would drown the report
+    logging.basicConfig(level=logging.ERROR)
+    files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "*.stl")))
+    results = run(files, args.synthetic, args.step, args.repeat)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for model, stage, ratio in regressions:
+            print("REGRESSION {} {}: {:.2f}x slower".format(model, stage, ratio))
+        if len(regressions) > 0:
+            return 1
+        print("No regression above {:.0%}".format(args.threshold))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,197 @@
 
 # https://github.com/stephenyeargin/stl-files
 
-import vpython
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider
 import re
 import numpy as np
+import os
+import mmap
+import time
+import heapq
+import bisect
+from collections import defaultdict, deque
+from typing import NamedTuple
+import argparse
+import logging
+import json
+import hashlib
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+import cProfile
+import pstats
+import io
+import tracemalloc
+from multiprocessing import shared_memory
 from math import atan2, pi
 
-class Point:
-    def __init__(self,x,y,z):
-        self.x = x
-        self.y = y
-        self.z = z
-    
-    def __eq__(self, value: object) -> bool:
-        return self.x == value.x and self.y == value.y and self.z == value.z
-    
+logger = logging.getLogger(__name__)
+
+# coordinates are rounded to this number of decimals
+DECIMALS = 6
+# fixed point coordinates are integer multiples of 10**-DECIMALS (1 nm for a model in mm)
+SCALE = 10**DECIMALS
+
+# stage timers, counters, gauges and histograms of a run. Disabled by default: every method returns at once and timer()
+# hands back a shared no-op context, so the instrumented code costs a method call per layer
+class Metrics:
+    # upper bounds of the histogram buckets, the last bucket (+Inf) is implicit
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+    NO_TIMER = nullcontext()
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, seconds]
+        self.timers: dict[str, list[float]] = {}
+        self.counters: dict[str, float] = {}
+        # values measured once, like a peak, rather than added up
+        self.gauges: dict[str, float] = {}
+        # name -> per bucket counts (not cumulative), then sum and count
+        self.histograms: dict[str, list[float]] = {}
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled: return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        if not self.enabled: return
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        if not self.enabled: return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0] * (len(self.BUCKETS) + 3)
+        histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def add_time(self, name: str, seconds: float):
+        if not self.enabled: return
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+    def timer(self, name: str):
+        if not self.enabled:
+            return self.NO_TIMER
+        return self.measure(name)
+
+    @contextmanager
+    def measure(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    # the time spent producing each item of iterable is added to the timer name
+    def timed(self, iterable, name: str):
+        if not self.enabled:
+            return iterable
+        return self.time_items(iterable, name)
+
+    def time_items(self, iterable, name: str):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    # plain data, so that worker processes can send their metrics back to be merged
+    def state(self) -> dict:
+        return {"timers": self.timers, "counters": self.counters, "gauges": self.gauges, "histograms": self.histograms}
+
+    def merge(self, state: dict):
+        if not self.enabled: return
+        for name, (calls, seconds) in state["timers"].items():
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        for name, value in state["counters"].items():
+            self.count(name, value)
+        # the gauges of several processes are not added, the largest value is kept
+        for name, value in state["gauges"].items():
+            self.gauge(name, max(value, self.gauges.get(name, value)))
+        for name, values in state["histograms"].items():
+            histogram = self.histograms.setdefault(name, [0] * (len(self.BUCKETS) + 3))
+            for i, value in enumerate(values):
+                histogram[i] += value
+
+    def to_json(self) -> str:
+        histograms = {}
+        for name, values in self.histograms.items():
+            bounds = [str(bound) for bound in self.BUCKETS] + ["+Inf"]
+            histograms[name] = {"buckets": dict(zip(bounds, values[:-2])), "sum": values[-2], "count": values[-1]}
+        timers = {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.timers.items()}
+        return json.dumps({"timers": timers, "counters": self.counters, "gauges": self.gauges, "histograms": histograms}, indent=1)
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix: str = "slicer") -> str:
+        lines = []
+        if len(self.timers) > 0:
+            lines.append("# TYPE {}_stage_seconds_total counter".format(prefix))
+            lines.extend('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, name, seconds) for name, (_, seconds) in self.timers.items())
+            lines.append("# TYPE {}_stage_calls_total counter".format(prefix))
+            lines.extend('{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, name, calls) for name, (calls, _) in self.timers.items())
+        for name, value in self.counters.items():
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total {}".format(prefix, name, value))
+        for name, value in self.gauges.items():
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            lines.append("{}_{} {}".format(prefix, name, value))
+        for name, values in self.histograms.items():
+            lines.append("# TYPE {}_{} histogram".format(prefix, name))
+            cumulative = 0
+            for bound, value in zip([str(bound) for bound in self.BUCKETS] + ["+Inf"], values[:-2]):
+                cumulative += value
+                lines.append('{}_{}_bucket{{le="{}"}} {}'.format(prefix, name, bound, cumulative))
+            lines.append("{}_{}_sum {}".format(prefix, name, values[-2]))
+            lines.append("{}_{}_count {}".format(prefix, name, values[-1]))
+        return "\n".join(lines) + "\n"
+
+# the metrics of this process, enabled by the CLI
+metrics = Metrics()
+
+# the geometry types are immutable tuples: no per-instance __dict__, and they can be used in sets and as dict keys.
+# Points are compared on their coordinates, which are already quantized by global_round
+class Point(NamedTuple):
+    x: float
+    y: float
+    z: float
+
     def __str__(self):
         return 'x: {} y: {} z: {}'.format(self.x, self.y, self.z)
 
-class Segment:
-    def __init__(self, p: Point, q: Point, normal: Point = Point(0,0,0)):
-        self.p = p
-        self.q = q
-        self.normal = normal
-    
+class Segment(NamedTuple):
+    p: Point
+    q: Point
+    normal: Point = Point(0, 0, 0)
+
+    # a segment is equal to its reversed copy, whatever its normal. It is never equal to a plain tuple, whose hash differs
     def __eq__(self, value: object) -> bool:
+        if not isinstance(value, Segment):
+            return False
         return (self.p == value.p and self.q == value.q) or (self.p == value.q and self.q == value.p)
-    
+
+    def __ne__(self, value: object) -> bool:
+        return not self == value
+
+    def __hash__(self) -> int:
+        return hash(frozenset((self.p, self.q)))
+
+    # the tuple order depends on the direction and would disagree with ==, segments are not ordered
+    def __lt__(self, value: object):
+        return NotImplemented
+
+    __le__ = __gt__ = __ge__ = __lt__
+
     def __str__(self):
         return 'p: {} q: {} normal: {}\n'.format(self.p, self.q, self.normal)
     
@@ -39,11 +201,17 @@ class Segment:
         dz = global_round(self.q.z - self.p.z)
         return Point(dx, dy, dz)
 
-class Polygon:
-    def __init__(self, points: list[Point], normal: Point = Point(0,0,0)):
-        self.points = points
-        self.normal = normal
-    
+class PolygonFields(NamedTuple):
+    points: tuple[Point, ...]
+    normal: Point = Point(0, 0, 0)
+
+# points may be given as any iterable, they are stored as a tuple so that the polygon stays hashable
+class Polygon(PolygonFields):
+    __slots__ = ()
+
+    def __new__(cls, points, normal: Point = Point(0, 0, 0)):
+        return super().__new__(cls, tuple(points), normal)
+
     def get_edges(self) -> list[Segment]:
         edges = []
         for i in range(0, len(self.points)-1):
@@ -51,56 +219,182 @@ class Polygon:
         edges.append(Segment(self.points[-1], self.points[0], self.normal))
         return edges
 
-class Surface:
-    def __init__(self, points: list[Point], fill: bool):
-        self.points = points
-        self.fill = fill
+class SurfaceFields(NamedTuple):
+    points: tuple[Point, ...]
+    fill: bool
+
+class Surface(SurfaceFields):
+    __slots__ = ()
+
+    def __new__(cls, points, fill: bool):
+        return super().__new__(cls, tuple(points), fill)
+
+# binary STL: 80 bytes header, uint32 triangle count, then 50 bytes per triangle
+STL_HEADER_SIZE = 84
+STL_BINARY_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attributes', '<u2')])
+
+# an STL is binary when its size matches the triangle count stored in the header.
+# The "solid" keyword is not reliable, many exporters write it in binary headers too
+def is_binary_stl(filename: str) -> bool:
+    size = os.path.getsize(filename)
+    if size < STL_HEADER_SIZE: return False
+    with open(filename, mode='rb') as file:
+        header = file.read(STL_HEADER_SIZE)
+    count = int.from_bytes(header[80:84], byteorder='little')
+    return size == STL_HEADER_SIZE + count * STL_BINARY_DTYPE.itemsize
+
+def read_binary_stl(filename: str) -> tuple[np.ndarray, np.ndarray]:
+    with open(filename, mode='rb') as file:
+        count = int.from_bytes(file.read(STL_HEADER_SIZE)[80:84], byteorder='little')
+    data = np.fromfile(filename, dtype=STL_BINARY_DTYPE, count=count, offset=STL_HEADER_SIZE)
+    vertices = round_array(data['vertices'].astype(np.float64))
+    normals = round_array(data['normal'].astype(np.float64))
+    return vertices, normals
+
+# ASCII STL files are read in chunks of whole facets so memory stays bounded on huge files
+STL_ASCII_CHUNK_SIZE = 1 << 24
+# token layout of an ASCII facet: facet normal x y z outer loop vertex x y z vertex x y z vertex x y z endloop endfacet
+STL_ASCII_FACET_TOKENS = 21
+STL_ASCII_KEYWORDS = {0: b"facet", 1: b"normal", 5: b"outer", 6: b"loop", 7: b"vertex", 11: b"vertex", 15: b"vertex", 19: b"endloop", 20: b"endfacet"}
+STL_ASCII_NUMBERS = [2, 3, 4, 8, 9, 10, 12, 13, 14, 16, 17, 18]
+# used when a chunk does not follow the layout above (extra tokens, several solids...)
+STL_ASCII_NORMAL = re.compile(rb"facet\s+normal\s+(\S+)\s+(\S+)\s+(\S+)")
+STL_ASCII_VERTEX = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
 
-class ParserState:
-    WaitingPoint = 0
-    ReadingPoint = 1
-    WaitingNormal = 2
+# parse a chunk of whole facets into a (n, 12) array: the normal followed by the three vertices.
+# Numbers are converted by NumPy in a single call, so any float notation is accepted (1, -2.5, 1e-05, +3.E2 ...)
+def parse_ascii_facets(chunk: bytes) -> np.ndarray:
+    tokens = chunk.split()
+    n = len(tokens) // STL_ASCII_FACET_TOKENS
+    if len(tokens) == n * STL_ASCII_FACET_TOKENS and all(tokens[i::STL_ASCII_FACET_TOKENS].count(keyword) == n for i, keyword in STL_ASCII_KEYWORDS.items()):
+        return np.array([tokens[i::STL_ASCII_FACET_TOKENS] for i in STL_ASCII_NUMBERS], dtype=np.float64).reshape(12, n).T
+    normals = STL_ASCII_NORMAL.findall(chunk)
+    vertices = STL_ASCII_VERTEX.findall(chunk)
+    if len(vertices) != 3 * len(normals):
+        raise Exception("Invalid STL file: {} facets but {} vertices".format(len(normals), len(vertices)))
+    normals = np.array(normals, dtype=np.float64).reshape(-1, 3)
+    vertices = np.array(vertices, dtype=np.float64).reshape(-1, 9)
+    return np.hstack([normals, vertices])
+
+def read_ascii_stl(filename: str) -> tuple[np.ndarray, np.ndarray]:
+    facets = [np.empty((0, 12))]
+    with open(filename, mode='rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # skip the "solid <name>" line and the trailing "endsolid <name>"
+                start = data.find(b"\n") + 1
+                end = data.rfind(b"endsolid")
+                if end < start: end = size
+                while start < end:
+                    stop = end
+                    if end - start > STL_ASCII_CHUNK_SIZE:
+                        last_facet = data.rfind(b"endfacet", start, start + STL_ASCII_CHUNK_SIZE)
+                        if last_facet != -1: stop = last_facet + len(b"endfacet")
+                    facets.append(parse_ascii_facets(data[start:stop]))
+                    start = stop
+    facets = np.concatenate(facets)
+    vertices = round_array(facets[:, 3:].reshape(-1, 3, 3))
+    normals = round_array(facets[:, :3])
+    return vertices, normals
+
+# load an STL file (binary or ASCII) into a (n, 3, 3) array of triangle vertices and a (n, 3) array of facet normals
+def load_stl(filename: str) -> tuple[np.ndarray, np.ndarray]:
+    if is_binary_stl(filename):
+        return read_binary_stl(filename)
+    return read_ascii_stl(filename)
+
+def polygons_from_arrays(vertices: np.ndarray, normals: np.ndarray) -> list[Polygon]:
+    return [Polygon(tuple(Point(*v) for v in triangle), Point(*normal)) for triangle, normal in zip(vertices.tolist(), normals.tolist())]
 
 def parse_stl(filename: str) -> list[Polygon]:
-    regex_point = re.compile(r"(.+)?vertex (?P<x>-?\d+\.\d+) (?P<y>-?\d+\.\d+) (?P<z>-?\d+\.\d+)")
-    regex_normal = re.compile(r"(.+)?facet normal (?P<x>-?\d+\.\d+) (?P<y>-?\d+\.\d+) (?P<z>-?\d+\.\d+)")
-    polys = []
-    with open(filename, mode='r') as file:
-        state = ParserState.WaitingNormal
-        points = []
-        normal = None
-        for row in file:
-            if state == ParserState.WaitingNormal:
-                r = regex_normal.match(row)
-                if r:
-                    d = r.groupdict()
-                    x = global_round(float(d["x"]))
-                    y = global_round(float(d["y"]))
-                    z = global_round(float(d["z"]))
-                    normal = Point(x,y,z)
-                    state = ParserState.WaitingPoint
-                continue
-            if state == ParserState.WaitingPoint:
-                if "outer loop" in row:
-                    state = ParserState.ReadingPoint
-                continue
-            if state == ParserState.ReadingPoint:
-                r = regex_point.match(row)
-                if r:
-                    d = r.groupdict()
-                    x = global_round(float(d["x"]))
-                    y = global_round(float(d["y"]))
-                    z = global_round(float(d["z"]))
-                    points.append(Point(x,y,z))
-                if "endloop" in row:
-                    if len(points) == 3:
-                        # print(normal)
-                        polys.append(Polygon(points, normal))
-                    points = []
-                    state = ParserState.WaitingNormal
-                continue
-    file.close()
-    return polys
+    return polygons_from_arrays(*load_stl(filename))
+
+# indexed triangle mesh: each vertex is stored once and faces refer to it by index
+class Mesh:
+    def __init__(self, vertices: np.ndarray, faces: np.ndarray, normals: np.ndarray):
+        self.vertices = vertices
+        self.faces = faces
+        self.normals = normals
+
+    # vertices are welded on the coordinates quantized to DECIMALS, the same grid used by global_round.
+    # The keys are sorted with lexsort (stable, x then y then z) and a vertex starts at every change of key, which
+    # gives the same vertices and faces as np.unique(axis=0) several times faster
+    @staticmethod
+    def from_triangles(triangles: np.ndarray, normals: np.ndarray) -> 'Mesh':
+        points = triangles.reshape(-1, 3)
+        if len(points) == 0:
+            return Mesh(points, np.empty((0, 3), dtype=np.int32), normals)
+        keys = to_fixed(points)
+        order = np.lexsort(keys.T[::-1])
+        sorted_keys = keys[order]
+        new = np.empty(len(order), dtype=bool)
+        new[0] = True
+        np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1, out=new[1:])
+        inverse = np.empty(len(order), dtype=np.int32)
+        inverse[order] = np.cumsum(new, dtype=np.int32) - 1
+        return Mesh(points[order[new]], inverse.reshape(-1, 3), normals)
+
+    def triangles(self) -> np.ndarray:
+        return self.vertices[self.faces]
+
+    # the same mesh with int64 fixed point vertices
+    def to_fixed(self) -> 'Mesh':
+        return Mesh(to_fixed(self.vertices), self.faces, self.normals)
+
+    # polygons share the Point of each welded vertex
+    def polygons(self) -> list[Polygon]:
+        points = [Point(*v) for v in self.vertices.tolist()]
+        return [Polygon(tuple(points[i] for i in face), Point(*normal)) for face, normal in zip(self.faces.tolist(), self.normals.tolist())]
+
+    def z_bounds(self) -> tuple[float, float]:
+        z = self.vertices[:, 2]
+        return float(z.min()), float(z.max())
+
+    @property
+    def nbytes(self) -> int:
+        return self.vertices.nbytes + self.faces.nbytes + self.normals.nbytes
+
+def load_mesh(filename: str) -> Mesh:
+    return Mesh.from_triangles(*load_stl(filename))
+
+# z levels of the layers, from the bottom of the model up to (excluding) the top
+def layer_levels(min_z: float, max_z: float, step: float) -> list[float]:
+    return [global_round(z) for z in np.arange(min_z, max_z, step).tolist()]
+
+# triangles sorted by their lowest z. Sweeping the layers bottom-up, a triangle enters the active set
+# when the plane reaches its zmin and leaves it once the plane is above its zmax, so each layer
+# only tests the triangles that span it
+class TriangleIndex:
+    def __init__(self, mesh: Mesh, candidates: np.ndarray | None = None):
+        z = mesh.vertices[mesh.faces, 2]
+        self.zmin = z.min(axis=1)
+        self.zmax = z.max(axis=1)
+        # by default facets with a vertical normal are skipped, they never produce segments (see intersect_polygon_plane)
+        if candidates is None:
+            candidates = np.flatnonzero((mesh.normals[:, 0] != 0) | (mesh.normals[:, 1] != 0))
+        self.order = candidates[np.argsort(self.zmin[candidates], kind='stable')]
+
+    # yield (z, faces) for every level, faces being the indices of the triangles spanning z in mesh order.
+    # Levels must be increasing
+    def sweep(self, z_levels: list[float]):
+        order = self.order.tolist()
+        zmin = self.zmin.tolist()
+        zmax = self.zmax.tolist()
+        active = []
+        next_face = 0
+        previous_z = -np.inf
+        for z in z_levels:
+            if z < previous_z:
+                raise Exception("Layers must be sliced bottom-up")
+            previous_z = z
+            while next_face < len(order) and zmin[order[next_face]] <= z:
+                face = order[next_face]
+                heapq.heappush(active, (zmax[face], face))
+                next_face += 1
+            while len(active) > 0 and active[0][0] < z:
+                heapq.heappop(active)
+            yield z, sorted(face for _, face in active)
 
 def flatten(list):
     return [item for sublist in list for item in sublist]
@@ -128,45 +422,151 @@ def intersect_polygon_plane(poly: Polygon, z_level: float) -> list[Segment]:
     if len(no_duplicate_points) == 2: return [Segment(no_duplicate_points[0], no_duplicate_points[1], poly.normal)]
     return []
 
-def draw_layer(layer: list[Segment]):
-    for segment in layer:
-        vpython.sphere(pos=vpython.vector(segment.p.x, segment.p.y, segment.p.z),radius=0.02)
-        vpython.sphere(pos=vpython.vector(segment.q.x, segment.q.y, segment.q.z),radius=0.02)
-        vpython.curve(vpython.vector(segment.p.x, segment.p.y, segment.p.z), vpython.vector(segment.q.x, segment.q.y, segment.q.z))
+# slots i < j of the candidate points of a triangle, used to find the points already seen
+EARLIER_SLOTS = np.tril(np.ones((6, 6), dtype=bool), -1)
+
+# vectorized intersect_polygon_plane over many triangles. triangles is (k, 3, 3) and z_level is either a
+# single level or one level per triangle, so several layers can be cut in a single call.
+# Returns the (s, 2, 3) cut segments and the index of the triangle each segment comes from
+def intersect_triangles_plane(triangles: np.ndarray, z_level, normals: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    k = len(triangles)
+    z = np.broadcast_to(np.asarray(z_level, dtype=np.float64), (k,))[:, None]
+    # edges p -> q in the order of Polygon.get_edges
+    p = triangles
+    q = np.roll(triangles, -1, axis=1)
+    fixed_point = np.issubdtype(triangles.dtype, np.integer)
+    d = q - p if fixed_point else round_array(q - p)
+    # same rules as intersect_segment_plane: an edge parallel to the plane hits it with both its points
+    # when it lies on it, any other edge hits it in one point if 0 <= t <= 1
+    parallel = d[:, :, 2] == 0
+    on_plane = parallel & (q[:, :, 2] == z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (z - p[:, :, 2]) / d[:, :, 2]
+        if fixed_point:
+            hit = fixed_edge_points(p, q, z)
+        else:
+            hit = round_array(p + t[:, :, None] * d)
+    crossing = ~parallel & (t >= 0) & (t <= 1)
+    # two candidate slots per edge, [p, q] or [hit]
+    candidates = np.stack([np.where(on_plane[:, :, None], p, hit), q], axis=2).reshape(k, 6, 3)
+    valid = np.stack([on_plane | crossing, on_plane], axis=2).reshape(k, 6)
+    # drop the points equal to an earlier one, then keep the triangles left with exactly 2 points
+    same = np.all(candidates[:, :, None, :] == candidates[:, None, :, :], axis=3)
+    duplicate = np.any(same & valid[:, None, :] & EARLIER_SLOTS, axis=2)
+    unique = valid & ~duplicate
+    selected = unique.sum(axis=1) == 2
+    if normals is not None:
+        selected &= (normals[:, 0] != 0) | (normals[:, 1] != 0)
+    rows = np.flatnonzero(selected)
+    slots = np.argsort(~unique[rows], axis=1, kind='stable')[:, :2]
+    return candidates[rows[:, None], slots], rows
+
+# fixed point intersection of the plane with the edges a -> b. Each point is computed from the lower end of
+# its edge, so an edge shared by two faces is cut at the same point whatever its direction, and it is
+# quantized once
+def fixed_edge_points(a: np.ndarray, b: np.ndarray, z_level) -> np.ndarray:
+    swap = (a[..., 2] > b[..., 2])[..., None]
+    low = np.where(swap, b, a)
+    high = np.where(swap, a, b)
+    t = (z_level - low[..., 2]) / (high[..., 2] - low[..., 2])
+    return low + np.rint(t[..., None] * (high - low)).astype(np.int64)
+
+# cut the layers swept by index in batches: the (triangle, level) pairs of several consecutive layers
+# go through a single intersect_triangles_plane call. Yields (z, segments, faces) for every level
+def sweep_segments(mesh: Mesh, index: TriangleIndex, z_levels: list[float], batch_size: int = 1 << 15):
+    triangles = mesh.triangles()
+    pending = []
+    pairs = 0
+    for z, faces in index.sweep(z_levels):
+        pending.append((z, faces))
+        pairs += len(faces)
+        if pairs >= batch_size:
+            yield from cut_layers(triangles, pending)
+            pending = []
+            pairs = 0
+    yield from cut_layers(triangles, pending)
+
+def cut_layers(triangles: np.ndarray, layers: list[tuple[float, list[int]]]):
+    if len(layers) == 0: return
+    counts = [len(faces) for _, faces in layers]
+    faces = np.array(flatten([faces for _, faces in layers]), dtype=np.int64)
+    levels = np.repeat([z for z, _ in layers], counts)
+    layer_ids = np.repeat(np.arange(len(layers)), counts)
+    segments, rows = intersect_triangles_plane(triangles[faces], levels)
+    # rows are sorted, so the segments of each layer are contiguous and keep the mesh order
+    bounds = np.searchsorted(layer_ids[rows], np.arange(len(layers) + 1))
+    for i, (z, _) in enumerate(layers):
+        yield z, segments[bounds[i]:bounds[i + 1]], faces[rows[bounds[i]:bounds[i + 1]]]
+
+def segments_from_array(segments: np.ndarray, normals: np.ndarray) -> list[Segment]:
+    return [Segment(Point(*p), Point(*q), Point(*normal)) for (p, q), normal in zip(segments.tolist(), normals.tolist())]
 
+# all the segments of a layer as a single Line3DCollection on ax (a new 3D axes when None)
+def draw_layer(layer: list[Segment], ax=None):
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+    if ax is None:
+        ax = plt.figure().add_subplot(projection='3d')
+    lines = Line3DCollection([[(s.p.x, s.p.y, s.p.z), (s.q.x, s.q.y, s.q.z)] for s in layer], linewidths=0.5)
+    ax.add_collection3d(lines)
+    return lines
+
+# the first occurrence of each element is kept
 def remove_duplicates(list):
-    no_duplicates_list = []
-    for elem in list:
-        if elem not in no_duplicates_list:
-            no_duplicates_list.append(elem)
-    return no_duplicates_list
+    return [*dict.fromkeys(list)]
+
+def unique_segments(segments: list[Segment]) -> list[Segment]:
+    return remove_duplicates(segments)
 
 # create a list of polygons using the available segments. A segment cannot compose more than 1 polygon.
 # segments that belong to the same line (so they are consecutive and parallel), are merged into a single segment 
-# If there is a segment that is shared between two polygons, throw an exception
+# If there is a segment that is shared between two polygons, throw an exception.
+# A polygon is filled when it is nested in an even number of polygons (see contour_tree)
 def surfaces_from_segments(segments: list[Segment]):
     if len(segments) == 0: return []
     edges = segments
-    current_edge = edges.pop(0)
+    # for each endpoint, the edges touching it that are not part of a polygon yet
+    touching: dict[Point, set[int]] = defaultdict(set)
+    for i, edge in enumerate(edges):
+        touching[edge.p].add(i)
+        touching[edge.q].add(i)
+    used = [False] * len(edges)
+    next_edge = 0
+
+    def pop_edge(i: int) -> Segment:
+        touching[edges[i].p].discard(i)
+        touching[edges[i].q].discard(i)
+        used[i] = True
+        return edges[i]
+
+    # edges are started in their original order
+    def pop_first() -> Segment | None:
+        nonlocal next_edge
+        while next_edge < len(edges) and used[next_edge]:
+            next_edge += 1
+        if next_edge == len(edges): return None
+        return pop_edge(next_edge)
+
+    current_edge = pop_first()
     surface_edges: list[Segment] = [current_edge]
     surfaces: list[Surface] = []
 
-    while len(edges)>=0:
+    while True:
         # search for edges that have a point in common with the current new edge
-        consecutive_edges_from_q = [edge for edge in edges if current_edge.q == edge.p or current_edge.q == edge.q]
-        consecutive_edges_from_p = [edge for edge in edges if current_edge.p == edge.p or current_edge.p == edge.q]
+        consecutive_edges_from_q = touching.get(current_edge.q, ())
+        consecutive_edges_from_p = touching.get(current_edge.p, ())
         # if the edge has more than 1 segment in common on one of the two ends, throw an exception
         if len(consecutive_edges_from_p) > 1 or len(consecutive_edges_from_q) > 1:
             raise Exception("Invalid mesh")
-        if len(consecutive_edges_from_p) == 1 and (len(consecutive_edges_from_q) == 0 or len(consecutive_edges_from_q) == 1):
-            found_edge = consecutive_edges_from_p[0]
-        elif len(consecutive_edges_from_p) == 0 and len(consecutive_edges_from_q) == 1:
-            found_edge = consecutive_edges_from_q[0]
+        if len(consecutive_edges_from_p) == 1:
+            found_edge_idx = next(iter(consecutive_edges_from_p))
+        elif len(consecutive_edges_from_q) == 1:
+            found_edge_idx = next(iter(consecutive_edges_from_q))
         else:
-            found_edge = None
+            found_edge_idx = None
         
-        if found_edge is not None:
-            found_edge_idx = edges.index(found_edge)
+        if found_edge_idx is not None:
+            found_edge = pop_edge(found_edge_idx)
             # if it's colinear we merge it with the current edge and we update the last edge of the polygon
             if check_parallel(current_edge, found_edge):
                 current_edge = merge_consecutive_parallel(current_edge, found_edge)
@@ -176,7 +576,6 @@ def surfaces_from_segments(segments: list[Segment]):
                 current_edge = found_edge
                 surface_edges.append(found_edge)
             
-            edges.pop(found_edge_idx)
             # then we check if the updated current edge is the end of the polygon
             # we need at least 3 edges to complete a polygon
             if len(surface_edges) > 2 and check_consecutive(surface_edges[0], current_edge):
@@ -185,23 +584,19 @@ def surfaces_from_segments(segments: list[Segment]):
                 if check_parallel(surface_edges[0], current_edge):
                     surface_edges[0] = merge_consecutive_parallel(surface_edges[0], current_edge)
                     surface_edges.pop(-1)
-                normal = Segment(Point(0,0,0), surface_edges[0].normal, surface_edges[0].normal)
-                fill = angle_between_segments(surface_edges[0], normal) < pi
-                # print("Polygon\n")
-                # for s in surface_edges:
-                    # print(s)
                 points = remove_duplicates(flatten([[s.p,s.q] for s in surface_edges]))
                 points = sort_clockwise(points)
-                surfaces.append(Surface(points, fill))
-                if len(edges) == 0: break
-                current_edge = edges.pop(0)
+                surfaces.append(Surface(tuple(points), True))
+                current_edge = pop_first()
+                if current_edge is None: break
                 surface_edges = [current_edge]
         else:
-            if len(edges) == 0: break
-            current_edge = edges.pop(0)
+            current_edge = pop_first()
+            if current_edge is None: break
             surface_edges = [current_edge]
 
-    return surfaces
+    depth = contour_parents([surface.points for surface in surfaces])[1]
+    return [Surface(surface.points, d % 2 == 0) for surface, d in zip(surfaces, depth.tolist())]
 
 def merge_consecutive_parallel(s1: Segment, s2: Segment) -> Segment:
     if s1.q == s2.p:
@@ -231,6 +626,9 @@ def check_consecutive(s1: Segment, s2: Segment) -> bool:
 def check_parallel(s1: Segment, s2: Segment) -> bool:
     dis1 = s1.get_displacement()
     dis2 = s2.get_displacement()
+    # fixed point coordinates: the segments are parallel when their cross product is exactly zero
+    if all(isinstance(v, int) for v in (dis1.x, dis1.y, dis1.z, dis2.x, dis2.y, dis2.z)):
+        return dis1.y * dis2.z == dis1.z * dis2.y and dis1.z * dis2.x == dis1.x * dis2.z and dis1.x * dis2.y == dis1.y * dis2.x
     if(dis2.x != 0):
         ratio = dis1.x / dis2.x
     elif(dis2.y != 0):
@@ -242,7 +640,24 @@ def check_parallel(s1: Segment, s2: Segment) -> bool:
     return global_round(dis2.x * ratio) == dis1.x and global_round(dis2.y * ratio) == dis1.y and global_round(dis2.z * ratio) == dis1.z
 
 def global_round(val: float) -> float:
-    return round(val, 6)
+    return round(val, DECIMALS)
+
+def to_fixed(values) -> np.ndarray:
+    return np.rint(np.asarray(values, dtype=np.float64) * SCALE).astype(np.int64)
+
+def from_fixed(surface: Surface) -> Surface:
+    return Surface(tuple(Point(p.x / SCALE, p.y / SCALE, p.z / SCALE) for p in surface.points), surface.fill)
+
+# global_round over an array. np.round scales the values before rounding them, which can push a value
+# lying next to a tie on the wrong side: those few values are rounded again with global_round
+def round_array(values: np.ndarray) -> np.ndarray:
+    scaled = values * 10**DECIMALS
+    rounded = np.rint(scaled) / 10**DECIMALS
+    with np.errstate(invalid='ignore'):
+        ties = np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-6
+    if np.any(ties):
+        rounded[ties] = [global_round(val) for val in values[ties].tolist()]
+    return rounded
 
 def mod2pi(angle: float) -> float:
     angle = angle % (2*pi)
@@ -255,56 +670,1056 @@ def angle_between_segments(s1: Segment, s2: Segment):
     a2 = mod2pi(atan2(s2.q.y - s2.p.y, s2.q.x - s2.p.x))
     return mod2pi(a2-a1)
 
-def main():
-    if len(sys.argv)<2:
-        print("STL file is missing")
-        return
-    filename = sys.argv[1]
-    model = parse_stl(filename)
-    layers = dict()
-    model_edges = flatten([poly.get_edges() for poly in model])
-    model_z_values = flatten([[edge.p.z, edge.q.z] for edge in model_edges])
-    min_z = min(model_z_values)
-    max_z = max(model_z_values)
-
-    # we need to create a layer every 0.1 mm (finest printing), so the step is 0.0001
-    non_optimized_layers = 0
-    optimized_layers = 0
-    step = 0.05
-    for z in np.arange(min_z, max_z, step):
-        z = global_round(z)
-        key = str(z)
-        layers[key] = []
-        layer_segments = []
-        for poly in model:
-            segments = intersect_polygon_plane(poly, z)
-            layer_segments += segments
-        layer_segments = remove_duplicates(layer_segments)
-        print("Segments found: ",len(layer_segments))
-        # non_optimized_layers+=len(layers[key])
-        # print("Original Layer [{}] has {} edges".format(key, len(layers[key])))
-        try:
-            layers[key] = surfaces_from_segments(layer_segments)
-            print("Polygons found: ",len(layers[key]))
-            for surf in layers[key]:
-                print("len {} infill {}".format(len(surf.points), surf.fill))
-        except Exception as e:
-            print(e)
-            continue   
-    # print("Non optimized model contains {} segments".format(non_optimized_layers))
-    # print("Optimized model layers {} segments".format(optimized_layers))
-        
-    def update_chart(val):
-        keys = [key for key in layers.keys() if float(key)<=val]
-        for k in keys:
-            for p in layers[k]:
-                pass
-                # draw_layer(p.poly.get_edges())
-
-    vpython.canvas(width=1500, height=1500)
-    update_chart(max_z)
+# edge adjacency of a mesh: each edge gets an id shared by the faces on its two sides.
+# Faces with a repeated vertex have no area and are left out
+class MeshTopology:
+    def __init__(self, mesh: Mesh):
+        self.mesh = mesh
+        faces = mesh.faces
+        self.faces = np.flatnonzero((faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0]))
+        # face edges in the order of Polygon.get_edges: v0 -> v1, v1 -> v2, v2 -> v0
+        directed = np.stack([faces[self.faces], np.roll(faces[self.faces], -1, axis=1)], axis=2).reshape(-1, 2)
+        edges, edge_ids, counts = np.unique(np.sort(directed, axis=1), axis=0, return_inverse=True, return_counts=True)
+        edge_ids = edge_ids.reshape(-1)
+        self.edges = edges
+        self.face_edges = np.full((len(faces), 3), -1, dtype=np.int64)
+        self.face_edges[self.faces] = edge_ids.reshape(-1, 3)
+        # the two faces of every edge, -1 for a border edge. Edges shared by more than two faces are not manifold
+        self.manifold = counts == 2
+        order = np.argsort(edge_ids, kind='stable')
+        owners = self.faces[order // 3]
+        offsets = np.cumsum(counts) - counts
+        self.edge_faces = np.stack([owners[offsets], np.where(counts > 1, owners[np.minimum(offsets + 1, len(owners) - 1)], -1)], axis=1)
+
+# slice the mesh at z_level walking from each crossed face to its neighbour across the shared crossed edge.
+# Vertices lying on the plane are taken as below it, so a crossed face has exactly two crossed edges and
+# every edge is cut once for both its faces: loops are closed and ordered without comparing any point.
+# With outward normals, outer boundaries come out counterclockwise and holes clockwise.
+# faces restricts the walk to a sorted subset of faces containing all the crossed ones (see TriangleIndex)
+def trace_contours(topology: MeshTopology, z_level: float, faces: np.ndarray | list[int] | None = None) -> list[Surface]:
+    mesh = topology.mesh
+    faces = topology.faces if faces is None else np.asarray(faces, dtype=np.int64)
+    face_edges = topology.face_edges[faces]
+    faces = faces[face_edges[:, 0] >= 0]
+    face_edges = face_edges[face_edges[:, 0] >= 0]
+    above = mesh.vertices[mesh.faces[faces], 2] > z_level
+    # a face edge v(j) -> v(j+1) goes up when it leaves the bottom side, down when it comes back
+    going_up = ~above & np.roll(above, -1, axis=1)
+    going_down = above & ~np.roll(above, -1, axis=1)
+    crossed = going_up.any(axis=1)
+    faces = faces[crossed]
+    if len(faces) == 0: return []
+    up_edges = face_edges[crossed][going_up[crossed]]
+    down_edges = face_edges[crossed][going_down[crossed]]
+    # the contour enters each face through its down edge and leaves it through its up edge
+    neighbours = topology.edge_faces[up_edges]
+    next_faces = np.where(neighbours[:, 0] == faces, neighbours[:, 1], neighbours[:, 0])
+    if not np.all(topology.manifold[up_edges]):
+        raise Exception("Invalid mesh")
+    # faces is sorted, the position of each next face is found among the crossed ones only
+    successors = np.minimum(np.searchsorted(faces, next_faces), len(faces) - 1)
+    if np.any(faces[successors] != next_faces) or np.any(down_edges[successors] != up_edges):
+        raise Exception("Invalid mesh")
+    points = edge_plane_points(mesh.vertices, topology.edges[up_edges], z_level)
+
+    surfaces = []
+    visited = np.zeros(len(faces), dtype=bool)
+    successors = successors.tolist()
+    for start in range(len(faces)):
+        if visited[start]: continue
+        loop = []
+        face = start
+        while not visited[face]:
+            visited[face] = True
+            loop.append(face)
+            face = successors[face]
+        loop_points = merge_collinear(points[loop])
+        if len(loop_points) < 3: continue
+        fill = signed_area(loop_points) > 0
+        surfaces.append(Surface(tuple(Point(*p) for p in loop_points.tolist()), fill))
+    return surfaces
+
+# intersection of the plane with edges (given as pairs of vertex ids) crossing it, computed from the lower vertex
+def edge_plane_points(vertices: np.ndarray, edges: np.ndarray, z_level: float) -> np.ndarray:
+    a = vertices[edges[:, 0]]
+    b = vertices[edges[:, 1]]
+    if np.issubdtype(vertices.dtype, np.integer):
+        return fixed_edge_points(a, b, z_level)
+    swap = a[:, 2] > b[:, 2]
+    a, b = np.where(swap[:, None], b, a), np.where(swap[:, None], a, b)
+    t = (z_level - a[:, 2]) / (b[:, 2] - a[:, 2])
+    return round_array(a + t[:, None] * (b - a))
+
+# drop repeated points (the contour passing through a vertex on the plane) and the points lying on the
+# line between their neighbours, within the rounding of global_round (one unit for fixed point coordinates)
+def merge_collinear(points: np.ndarray) -> np.ndarray:
+    tolerance = 1 if np.issubdtype(points.dtype, np.integer) else 10**-DECIMALS
+    points = points[np.any(points != np.roll(points, 1, axis=0), axis=1)]
+    while len(points) > 3:
+        previous = np.roll(points, 1, axis=0)
+        following = np.roll(points, -1, axis=0)
+        chord = following[:, :2] - previous[:, :2]
+        offset = points[:, :2] - previous[:, :2]
+        distance = np.abs(chord[:, 0] * offset[:, 1] - chord[:, 1] * offset[:, 0]) / np.maximum(np.hypot(chord[:, 0], chord[:, 1]), tolerance)
+        forward = np.sum(offset * chord, axis=1) > 0
+        collinear = (distance <= tolerance) & forward
+        if not np.any(collinear): break
+        # never drop two neighbours at once, the second one is checked again on the next pass
+        collinear &= ~np.roll(collinear, 1)
+        points = points[~collinear]
+    return points
+
+# shoelace formula, positive for counterclockwise loops
+def signed_area(points: np.ndarray) -> float:
+    x = points[:, 0]
+    y = points[:, 1]
+    return float(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)) / 2
+
+# intervals of integer positions 0..size-1 (bounds included) in a segment tree: each interval is stored in the
+# O(log size) nodes that cover it exactly, so adding and removing one costs O(log size) and stab(p) returns the
+# k intervals containing p in O(k + log size) by walking from the leaf of p to the root
+class IntervalStabbing:
+    def __init__(self, size: int):
+        self.size = 1 << max(size - 1, 0).bit_length()
+        self.nodes: list[set[int] | None] = [None] * (2 * self.size)
+
+    # the nodes covering lo..hi
+    def cover(self, lo: int, hi: int):
+        lo += self.size
+        hi += self.size + 1
+        while lo < hi:
+            if lo & 1:
+                yield lo
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                yield hi
+            lo >>= 1
+            hi >>= 1
+
+    def add(self, key: int, lo: int, hi: int):
+        for node in self.cover(lo, hi):
+            if self.nodes[node] is None:
+                self.nodes[node] = set()
+            self.nodes[node].add(key)
+
+    def remove(self, key: int, lo: int, hi: int):
+        for node in self.cover(lo, hi):
+            self.nodes[node].discard(key)
+
+    def stab(self, position: int) -> list[int]:
+        found = []
+        node = position + self.size
+        while node > 0:
+            if self.nodes[node]:
+                found.extend(self.nodes[node])
+            node >>= 1
+        return found
+
+# nesting of the closed, non crossing contours of a layer: parents[i] is the index of the smallest contour around
+# contour i (-1 for an outer boundary) and depth[i] the number of contours around it.
+# Candidate containers are found with a sweep over the bounding boxes sorted by xmin (as in TriangleIndex.sweep,
+# a contour is active while the sweep is within its x range). The active contours are also kept by y range in an
+# IntervalStabbing, so each probe only visits the boxes that contain it, even in a tall column of contours.
+# Then all the candidates are tested at once with the even-odd rule on the first point of the inner contour
+def contour_parents(loops: list[tuple[Point, ...]]) -> tuple[np.ndarray, np.ndarray]:
+    n = len(loops)
+    parents = np.full(n, -1, dtype=np.int64)
+    depth = np.zeros(n, dtype=np.int64)
+    if n < 2:
+        return parents, depth
+    loops = [np.array([(p.x, p.y) for p in points], dtype=np.float64) for points in loops]
+    low = np.array([loop.min(axis=0) for loop in loops])
+    high = np.array([loop.max(axis=0) for loop in loops])
+    probes = np.array([loop[0] for loop in loops])
+    area = np.abs([signed_area(loop) for loop in loops])
+
+    # the y of every bounding box bound and probe, as ranks in a shared list of coordinates
+    ys, ranks = np.unique(np.concatenate([low[:, 1], high[:, 1], probes[:, 1]]), return_inverse=True)
+    ylow, yhigh, yprobe = ranks.reshape(3, n).tolist()
+    by_xmin = np.argsort(low[:, 0], kind='stable').tolist()
+    xmin = low[:, 0].tolist()
+    xmax = high[:, 0].tolist()
+    # the loops whose x range contains the sweep position, in a heap by xmax and in y intervals
+    active = []
+    intervals = IntervalStabbing(len(ys))
+    next_loop = 0
+    inner, outer = [], []
+    for i in np.argsort(probes[:, 0], kind='stable').tolist():
+        x = probes[i, 0]
+        while next_loop < n and xmin[by_xmin[next_loop]] <= x:
+            j = by_xmin[next_loop]
+            heapq.heappush(active, (xmax[j], j))
+            intervals.add(j, ylow[j], yhigh[j])
+            next_loop += 1
+        while len(active) > 0 and active[0][0] < x:
+            j = heapq.heappop(active)[1]
+            intervals.remove(j, ylow[j], yhigh[j])
+        candidates = [j for j in intervals.stab(yprobe[i]) if j != i]
+        inner.extend([i] * len(candidates))
+        outer.extend(candidates)
+    if len(inner) == 0:
+        return parents, depth
+    inner = np.array(inner)
+    outer = np.array(outer)
+
+    # point in polygon for every (inner, outer) pair: one row per edge of the outer contour
+    sizes = np.array([len(loop) for loop in loops])
+    offsets = np.cumsum(sizes) - sizes
+    start = np.concatenate(loops)
+    end = np.concatenate([np.roll(loop, -1, axis=0) for loop in loops])
+    pair = np.repeat(np.arange(len(inner)), sizes[outer])
+    edge = offsets[outer][pair] + np.arange(len(pair)) - np.repeat(np.cumsum(sizes[outer]) - sizes[outer], sizes[outer])
+    px, py = probes[inner[pair]].T
+    x0, y0 = start[edge].T
+    x1, y1 = end[edge].T
+    spans = (y0 > py) != (y1 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = spans & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+    inside = np.bincount(pair, weights=crossing, minlength=len(inner)) % 2 == 1
+    inner, outer = inner[inside], outer[inside]
+
+    depth = np.bincount(inner, minlength=n)
+    # the parent is the smallest container
+    order = np.lexsort((area[outer], inner))
+    inner, outer = inner[order], outer[order]
+    first = np.ones(len(inner), dtype=bool)
+    first[1:] = inner[1:] != inner[:-1]
+    parents[inner[first]] = outer[first]
+    return parents, depth
+
+# the farthest point strictly between a and b from the chord a-b, and its distance, for every range (a, b) of points.
+# The distance is to the first point when the chord is closed (the first pass on a loop). Ranges must not be empty
+def farthest_points(points: np.ndarray, a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    inner = b - a - 1
+    span = np.repeat(np.arange(len(a)), inner)
+    index = a[span] + 1 + np.arange(len(span)) - np.repeat(np.cumsum(inner) - inner, inner)
+    chord = points[b] - points[a]
+    length = np.hypot(chord[:, 0], chord[:, 1])
+    offset = points[index] - points[a[span]]
+    cross = np.abs(chord[span, 0] * offset[:, 1] - chord[span, 1] * offset[:, 0])
+    distance = np.where(length[span] > 0, cross / np.where(length[span] > 0, length[span], 1), np.hypot(offset[:, 0], offset[:, 1]))
+    # the first point of each range after sorting by range, then distance decreasing
+    order = np.lexsort((-distance, span))
+    first = order[np.cumsum(inner) - inner]
+    return index[first], distance[first]
+
+# the segments p-q that properly cross another one. Segments meeting at an end point, or touching, do not count.
+# Pairs are only tested when their bounding boxes overlap: with the segments sorted by xmin, the candidates of
+# a segment are the next ones starting before its xmax
+def crossing_segments(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+    low = np.minimum(p, q)
+    high = np.maximum(p, q)
+    order = np.argsort(low[:, 0], kind='stable')
+    last = np.searchsorted(low[order, 0], high[order, 0], side='right')
+    counts = last - np.arange(len(order)) - 1
+    i = np.repeat(np.arange(len(order)), counts)
+    j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+    i, j = order[i], order[j]
+    overlap = (low[i, 1] <= high[j, 1]) & (low[j, 1] <= high[i, 1])
+    i, j = i[overlap], j[overlap]
+
+    def orientation(a, b, c):
+        return np.sign((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+    crossing = (orientation(p[i], q[i], p[j]) * orientation(p[i], q[i], q[j]) < 0) & (orientation(p[j], q[j], p[i]) * orientation(p[j], q[j], q[i]) < 0)
+    crossed = np.zeros(len(p), dtype=bool)
+    crossed[i[crossing]] = True
+    crossed[j[crossing]] = True
+    return crossed
+
+# Douglas-Peucker on closed loops, for all the loops of a layer at once. Each loop is opened into a polyline from
+# its first point back to itself, and every pass splits all the ranges whose farthest point is beyond tolerance
+# at that point, so there is one numpy pass per level of the recursion. Loops that would be left with fewer than
+# 3 vertices (smaller than the tolerance) are kept as they are, so no contour disappears or degenerates.
+# The loops are simplified together so that the topology of the layer is kept: while a simplified edge crosses
+# another one (a hole and its outline closer than tolerance, or a loop folding on itself), the farthest dropped
+# point of each crossing edge is put back. The input loops must not cross, restoring them is then always enough
+def simplify_loops(loops: list[np.ndarray], tolerance: float) -> list[np.ndarray]:
+    if len(loops) == 0 or tolerance <= 0:
+        return loops
+    sizes = np.array([len(loop) + 1 for loop in loops])
+    ends = np.cumsum(sizes) - 1
+    starts = ends - sizes + 1
+    points = np.concatenate([np.vstack([loop[:, :2], loop[:1, :2]]) for loop in loops]).astype(np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts] = True
+    keep[ends] = True
+    a, b = starts, ends
+    while len(a) > 0:
+        inner = b - a - 1
+        a, b = a[inner > 0], b[inner > 0]
+        if len(a) == 0: break
+        farthest, distance = farthest_points(points, a, b)
+        split = distance > tolerance
+        farthest = farthest[split]
+        keep[farthest] = True
+        a, b = np.concatenate([a[split], farthest]), np.concatenate([farthest, b[split]])
+    # the closing point of each loop is counted with its first point
+    loop_of = np.repeat(np.arange(len(loops)), sizes)
+    degenerate = np.bincount(loop_of, weights=keep, minlength=len(loops)) - 1 < 3
+    keep[degenerate[loop_of]] = True
     while True:
-        pass
+        kept = np.flatnonzero(keep)
+        # the edges between consecutive kept points of the same loop
+        a, b = kept[:-1], kept[1:]
+        same_loop = loop_of[a] == loop_of[b]
+        a, b = a[same_loop], b[same_loop]
+        crossed = crossing_segments(points[a], points[b]) & (b - a > 1)
+        if not np.any(crossed): break
+        keep[farthest_points(points, a[crossed], b[crossed])[0]] = True
+    return [loop[np.flatnonzero(keep[start:end])] for loop, start, end in zip(loops, starts.tolist(), ends.tolist())]
+
+def simplify_surfaces(surfaces: list[Surface], tolerance: float) -> list[Surface]:
+    loops = [np.array([(p.x, p.y, p.z) for p in surface.points]) for surface in surfaces]
+    return [Surface(tuple(Point(*p) for p in loop.tolist()), surface.fill) for surface, loop in zip(surfaces, simplify_loops(loops, tolerance))]
+
+class ContourNode(NamedTuple):
+    surface: Surface
+    depth: int
+    children: list['ContourNode']
+
+# outer boundaries -> holes -> islands -> ... as a forest of ContourNode. The fill of each surface follows its depth
+def contour_tree(surfaces: list[Surface]) -> list[ContourNode]:
+    parents, depth = contour_parents([surface.points for surface in surfaces])
+    nodes = [ContourNode(Surface(surface.points, d % 2 == 0), d, []) for surface, d in zip(surfaces, depth.tolist())]
+    roots = []
+    for node, parent in zip(nodes, parents.tolist()):
+        (roots if parent < 0 else nodes[parent].children).append(node)
+    return roots
+
+# slicing engines: "segments" cuts every triangle and chains the segments with surfaces_from_segments,
+# "topology" walks the mesh adjacency with trace_contours
+ENGINES = ("segments", "topology")
+
+# the per-mesh state of an engine, built once and reused for any number of levels.
+# With fixed_point the vertices are quantized once to int64 and the engine only works on integers:
+# points are matched, merged and compared exactly, no coordinate is rounded again
+class Slicer:
+    # quantized tells that the vertices of mesh are already fixed point (see slice_parallel)
+    def __init__(self, mesh: Mesh, engine: str = "segments", fixed_point: bool = False, quantized: bool = False):
+        if engine not in ENGINES:
+            raise Exception("Unknown engine {}".format(engine))
+        if fixed_point and not quantized:
+            mesh = mesh.to_fixed()
+        self.mesh = mesh
+        self.engine = engine
+        self.fixed_point = fixed_point
+        if engine == "topology":
+            self.topology = MeshTopology(mesh)
+            self.index = TriangleIndex(mesh, np.arange(len(mesh.faces)))
+        else:
+            self.index = TriangleIndex(mesh)
+
+    # yield (z, surfaces) for every level, in order. A layer where the mesh is invalid has no surfaces
+    def slice(self, z_levels: list[float]):
+        if not self.fixed_point:
+            yield from self.cut(z_levels)
+            return
+        for z, (_, surfaces) in zip(z_levels, self.cut(to_fixed(z_levels).tolist())):
+            yield z, [from_fixed(surface) for surface in surfaces]
+
+    # levels and surfaces in the units of self.mesh
+    def cut(self, z_levels: list[float]):
+        if self.engine == "topology":
+            for z, faces in self.index.sweep(z_levels):
+                self.record_tests(len(faces))
+                try:
+                    surfaces = trace_contours(self.topology, z, faces)
+                except Exception as e:
+                    self.record_invalid(z, e)
+                    surfaces = []
+                metrics.observe("contours_per_layer", len(surfaces))
+                yield z, surfaces
+            return
+        for z, segments, faces in sweep_segments(self.mesh, self.index, z_levels):
+            self.record_tests(len(faces))
+            layer_segments = unique_segments(segments_from_array(segments, self.mesh.normals[faces]))
+            metrics.observe("segments_per_layer", len(layer_segments))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Layer {}: {} segments".format(self.level(z), len(layer_segments)))
+            try:
+                surfaces = surfaces_from_segments(layer_segments)
+            except Exception as e:
+                self.record_invalid(z, e)
+                surfaces = []
+            metrics.observe("contours_per_layer", len(surfaces))
+            yield z, surfaces
+
+    # tests is the number of triangles the index returned for the layer
+    def record_tests(self, tests: int):
+        if not metrics.enabled: return
+        metrics.count("triangles_tested", tests)
+        metrics.observe("triangles_tested_per_layer", tests)
+
+    # the layer is skipped, it gets no surfaces
+    def record_invalid(self, z: float, error: Exception):
+        logger.warning("Layer {}: {}".format(self.level(z), error))
+        metrics.count("invalid_layers")
+
+    def level(self, z: float) -> float:
+        return z / SCALE if self.fixed_point else z
+
+# the slicer of a worker process, built by init_worker on the mesh arrays in shared memory
+worker_slicer: Slicer | None = None
+worker_memory: list[shared_memory.SharedMemory] = []
+
+def share_array(array: np.ndarray) -> tuple[shared_memory.SharedMemory, tuple]:
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+def attach_array(spec: tuple) -> np.ndarray:
+    name, shape, dtype = spec
+    memory = shared_memory.SharedMemory(name=name)
+    # keep the block mapped for the lifetime of the worker, the parent unlinks it
+    worker_memory.append(memory)
+    return np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+def init_worker(specs: list[tuple], engine: str, fixed_point: bool, collect_metrics: bool = False):
+    global worker_slicer
+    metrics.enabled = collect_metrics
+    vertices, faces, normals = [attach_array(spec) for spec in specs]
+    # in fixed point the shared vertices are already quantized, workers do not make their own int64 copy
+    worker_slicer = Slicer(Mesh(vertices, faces, normals), engine, fixed_point, quantized=fixed_point)
+
+# the layers of the chunk, and the metrics collected while slicing them
+def slice_chunk(z_levels: list[float]) -> tuple[list[tuple[float, list[Surface]]], dict]:
+    metrics.reset()
+    layers = list(worker_slicer.slice(z_levels))
+    return layers, metrics.state()
+
+def chunk_layers(future) -> list[tuple[float, list[Surface]]]:
+    layers, state = future.result()
+    metrics.merge(state)
+    return layers
+
+# slice z_levels on a pool of jobs processes. The mesh arrays are copied once into shared memory, with fixed_point
+# the vertices are quantized first. Each worker slices contiguous chunks of levels and the layers are yielded back in z order.
+# Only a few chunks per worker are in flight, so memory does not grow with the height of the model
+def slice_parallel(mesh: Mesh, z_levels: list[float], jobs: int, engine: str = "segments", fixed_point: bool = False, chunk_size: int = 64):
+    vertices = to_fixed(mesh.vertices) if fixed_point else mesh.vertices
+    shared = [share_array(array) for array in (vertices, mesh.faces, mesh.normals)]
+    try:
+        # at least a few chunks per worker so that the slow parts of the model are spread over the pool
+        chunk_size = max(1, min(chunk_size, -(-len(z_levels) // (jobs * 4))))
+        chunks = (z_levels[i:i + chunk_size] for i in range(0, len(z_levels), chunk_size))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=([spec for _, spec in shared], engine, fixed_point, metrics.enabled)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(slice_chunk, chunk))
+                if len(pending) >= 2 * jobs:
+                    yield from chunk_layers(pending.popleft())
+            while len(pending) > 0:
+                yield from chunk_layers(pending.popleft())
+    finally:
+        for memory, _ in shared:
+            memory.close()
+            memory.unlink()
+
+class Layer(NamedTuple):
+    z: float
+    surfaces: list[Surface]
+
+    # the nesting of the surfaces, computed on demand
+    @property
+    def tree(self) -> list[ContourNode]:
+        return contour_tree(self.surfaces)
+
+# every step from the bottom of the model, limited to z_range (min, max) when given. The levels do not
+# depend on z_range, so layers sliced with different ranges share their z
+def mesh_levels(mesh: Mesh, step: float, z_range: tuple[float, float] | None = None) -> list[float]:
+    min_z, max_z = mesh.z_bounds()
+    levels = layer_levels(min_z, max_z, step)
+    if z_range is not None:
+        levels = [z for z in levels if z_range[0] <= z <= z_range[1]]
+    return levels
+
+# |nz| of the unit normal of each facet: 0 on vertical walls, 1 on flat faces. Some exporters write zero normals,
+# those facets fall back to the normal of their vertices
+def facet_slopes(mesh: Mesh) -> np.ndarray:
+    normals = mesh.normals.astype(np.float64)
+    missing = ~normals.any(axis=1)
+    if missing.any():
+        triangles = mesh.triangles()[missing]
+        normals[missing] = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    length = np.linalg.norm(normals, axis=1)
+    return np.divide(np.abs(normals[:, 2]), length, out=np.zeros(len(normals)), where=length > 0)
+
+# range maximum over a fixed array with a sparse table: row k holds the maximum of the 2**k values starting at
+# each position, so any range is covered by two overlapping blocks and answered in O(1)
+class RangeMax:
+    def __init__(self, values: np.ndarray):
+        self.table = [values]
+        while 2 << (len(self.table) - 1) <= len(values):
+            half = 1 << (len(self.table) - 1)
+            row = self.table[-1]
+            self.table.append(np.maximum(row[:-half], row[half:]))
+
+    # maximum of values[lo..hi], both included
+    def query(self, lo: int, hi: int) -> float:
+        k = (hi - lo + 1).bit_length() - 1
+        row = self.table[k]
+        return max(row[lo], row[hi - (1 << k) + 1])
+
+    # the reverse operation: for count bins, the maximum of the values whose range lo..hi (included) covers each bin.
+    # Each range updates its two covering blocks, then the blocks are pushed down one level at a time
+    @staticmethod
+    def cover(count: int, lo: np.ndarray, hi: np.ndarray, values: np.ndarray) -> np.ndarray:
+        k = np.frexp((hi - lo + 1).astype(np.float64))[1] - 1
+        table = np.zeros((max(count.bit_length(), 1), count))
+        np.maximum.at(table, (k, lo), values)
+        np.maximum.at(table, (k, hi - (1 << k) + 1), values)
+        for level in range(len(table) - 1, 0, -1):
+            half = 1 << (level - 1)
+            starts = count - (1 << level) + 1
+            np.maximum(table[level - 1, :starts], table[level, :starts], out=table[level - 1, :starts])
+            np.maximum(table[level - 1, half:half + starts], table[level, :starts], out=table[level - 1, half:half + starts])
+        return table[0]
+
+# variable layer heights: a surface with unit normal n printed with layers of height h leaves steps of height
+# h*|nz| (the cusp), so each layer is as thick as allowed by the steepest facet it spans, between min_height
+# and max_height. Vertical walls get max_height, shallow slopes get thin layers
+def adaptive_levels(mesh: Mesh, min_height: float, max_height: float, cusp: float, z_range: tuple[float, float] | None = None) -> list[float]:
+    if not 0 < min_height <= max_height:
+        raise Exception("Invalid layer heights {} {}".format(min_height, max_height))
+    min_z, max_z = mesh.z_bounds()
+    slopes = facet_slopes(mesh)
+    # facets this close to vertical never limit the layer height, and flat facets leave no steps at all
+    steep = (slopes > cusp / max_height) & (slopes < 1)
+    z = mesh.vertices[mesh.faces[steep], 2]
+    # bins of min_height, each holding the largest slope of the facets spanning it
+    count = max(int(np.ceil((max_z - min_z) / min_height)), 1)
+    lo = np.clip(((z.min(axis=1) - min_z) // min_height).astype(np.int64), 0, count - 1)
+    hi = np.clip(((z.max(axis=1) - min_z) // min_height).astype(np.int64), 0, count - 1)
+    bins = RangeMax(RangeMax.cover(count, lo, hi, slopes[steep]))
+
+    def bin_of(z: float) -> int:
+        return min(int((z - min_z) // min_height), count - 1)
+
+    levels = []
+    z = min_z
+    while z < max_z:
+        levels.append(global_round(z))
+        # the allowed height only grows when the layer gets thinner, so this settles in at most two passes
+        height = max_height
+        while True:
+            slope = bins.query(bin_of(z), bin_of(z + height))
+            allowed = min(max(cusp / slope, min_height), max_height) if slope > 0 else max_height
+            if allowed >= height: break
+            height = allowed
+        z += height
+    if z_range is not None:
+        levels = [z for z in levels if z_range[0] <= z <= z_range[1]]
+    return levels
+
+# slice the mesh lazily, yielding one Layer at a time from the bottom up so that consumers can process
+# each layer as soon as it is ready. The levels are given by mesh_levels unless they are passed explicitly
+def slice_layers(mesh: Mesh, step: float = 0.05, z_range: tuple[float, float] | None = None, engine: str = "segments", jobs: int = 1, levels: list[float] | None = None, fixed_point: bool = False):
+    if levels is None:
+        levels = mesh_levels(mesh, step, z_range)
+    if jobs > 1:
+        sliced = slice_parallel(mesh, levels, jobs, engine, fixed_point)
+    else:
+        sliced = Slicer(mesh, engine, fixed_point).slice(levels)
+    for z, surfaces in sliced:
+        yield Layer(z, surfaces)
+
+# all the layers at once, keyed by z
+def slice_model(mesh: Mesh, step: float = 0.05, z_range: tuple[float, float] | None = None, engine: str = "segments", jobs: int = 1, fixed_point: bool = False) -> dict[float, list[Surface]]:
+    return {z: surfaces for z, surfaces in slice_layers(mesh, step, z_range, engine, jobs, fixed_point=fixed_point)}
+
+# on-disk cache of parsed meshes and sliced layers, keyed by the hash of the STL bytes. Layers are stored
+# per engine and keyed by z, so a new z range or step only slices the levels that are not cached yet.
+# Files are .npz archives; when the directory grows over max_bytes the least recently used ones are removed
+class SliceCache:
+    def __init__(self, directory: str, max_bytes: int = 512 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # number of layers sliced by the last slice_layers call, the others came from the cache
+        self.sliced_layers = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_hash(filename: str) -> str:
+        digest = hashlib.sha256()
+        with open(filename, mode='rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # the parsed mesh of filename and the key of its layers
+    def load_mesh(self, filename: str) -> tuple[Mesh, str]:
+        key = self.file_hash(filename)
+        path = self.path("{}.mesh.npz".format(key))
+        if os.path.exists(path):
+            os.utime(path)
+            with np.load(path) as data:
+                return Mesh(data["vertices"], data["faces"], data["normals"]), key
+        mesh = load_mesh(filename)
+        self.save(path, vertices=mesh.vertices, faces=mesh.faces, normals=mesh.normals)
+        return mesh, key
+
+    def layers_path(self, key: str, engine: str, fixed_point: bool) -> str:
+        return self.path("{}-{}{}.layers.npz".format(key, engine, "-fixed" if fixed_point else ""))
+
+    def load_layers(self, key: str, engine: str, fixed_point: bool = False) -> dict[float, list[Surface]]:
+        path = self.layers_path(key, engine, fixed_point)
+        if not os.path.exists(path): return {}
+        os.utime(path)
+        with np.load(path) as data:
+            surface_counts = data["surface_counts"].tolist()
+            point_counts = data["point_counts"].tolist()
+            fill = data["fill"].tolist()
+            points = data["points"].tolist()
+            levels = data["z"].tolist()
+        layers = {}
+        surface = 0
+        point = 0
+        for z, count in zip(levels, surface_counts):
+            surfaces = []
+            for _ in range(count):
+                surfaces.append(Surface(tuple(Point(*p) for p in points[point:point + point_counts[surface]]), fill[surface]))
+                point += point_counts[surface]
+                surface += 1
+            layers[z] = surfaces
+        return layers
+
+    def store_layers(self, key: str, engine: str, fixed_point: bool, layers: dict[float, list[Surface]]):
+        levels = sorted(layers.keys())
+        surfaces = [surface for z in levels for surface in layers[z]]
+        points = [[p.x, p.y, p.z] for surface in surfaces for p in surface.points]
+        self.save(self.layers_path(key, engine, fixed_point),
+            z=np.array(levels, dtype=np.float64),
+            surface_counts=np.array([len(layers[z]) for z in levels], dtype=np.int32),
+            point_counts=np.array([len(surface.points) for surface in surfaces], dtype=np.int32),
+            fill=np.array([surface.fill for surface in surfaces], dtype=bool),
+            points=np.array(points, dtype=np.float64).reshape(-1, 3))
+
+    # like slice_layers, only the levels missing from the cache are sliced
+    def slice_layers(self, mesh: Mesh, key: str, levels: list[float], engine: str = "segments", jobs: int = 1, fixed_point: bool = False):
+        cached = self.load_layers(key, engine, fixed_point)
+        missing = [z for z in levels if z not in cached]
+        self.sliced_layers = len(missing)
+        sliced = slice_layers(mesh, engine=engine, jobs=jobs, levels=missing, fixed_point=fixed_point)
+        for z in levels:
+            if z not in cached:
+                layer = next(sliced)
+                cached[z] = layer.surfaces
+            yield Layer(z, cached[z])
+        if len(missing) > 0:
+            self.store_layers(key, engine, fixed_point, cached)
+
+    # write through a temporary file so that an interrupted run never leaves a truncated archive
+    def save(self, path: str, **arrays):
+        temporary = path + ".tmp"
+        with open(temporary, mode='wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+        entries = sorted((os.stat(path).st_mtime, os.path.getsize(path), path) for path in entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes: break
+            os.remove(path)
+            total -= size
+
+# one JSON object per line: {"z": z, "surfaces": [{"fill": bool, "points": [[x, y], ...]}, ...]}
+def write_layer(file, layer: Layer):
+    surfaces = [{"fill": surface.fill, "points": [[p.x, p.y] for p in surface.points]} for surface in layer.surfaces]
+    file.write(json.dumps({"z": layer.z, "surfaces": surfaces}) + "\n")
+
+# rectilinear infill of the closed contours of a layer: (m, 2, 2) segments along the scanlines at angle (radians),
+# spaced by spacing on a grid shared by all layers, in zigzag order (every other scanline is run backwards).
+# The points inside are found with the even-odd rule on all the contours together, so holes are left empty
+# whatever the fill of each Surface. Each interval is shortened by margin at both ends to keep the infill off
+# the perimeters
+def scanline_infill(surfaces: list[Surface], spacing: float, angle: float = 0.0, margin: float = 0.0) -> np.ndarray:
+    loops = [np.array([(p.x, p.y) for p in surface.points]) for surface in surfaces if len(surface.points) > 2]
+    if len(loops) == 0:
+        return np.empty((0, 2, 2))
+    # rotate the contours so that the scanlines are horizontal
+    c, s = np.cos(angle), np.sin(angle)
+    rotation = np.array([[c, s], [-s, c]])
+    # edge table: one row per non horizontal edge, from its lower to its upper end
+    start = np.concatenate(loops) @ rotation.T
+    end = np.concatenate([np.roll(loop, -1, axis=0) for loop in loops]) @ rotation.T
+    swap = start[:, 1] > end[:, 1]
+    low = np.where(swap[:, None], end, start)
+    high = np.where(swap[:, None], start, end)
+    keep = low[:, 1] < high[:, 1]
+    low, high = low[keep], high[keep]
+    # scanline k is at y = k*spacing. An edge crosses the scanlines with low <= y < high, so a vertex shared by
+    # two edges is only counted once
+    first = np.ceil(low[:, 1] / spacing).astype(np.int64)
+    last = np.ceil(high[:, 1] / spacing).astype(np.int64) - 1
+    counts = np.maximum(last - first + 1, 0)
+    edge = np.repeat(np.arange(len(low)), counts)
+    line = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)
+    y = line * spacing
+    t = (y - low[edge, 1]) / (high[edge, 1] - low[edge, 1])
+    x = low[edge, 0] + t * (high[edge, 0] - low[edge, 0])
+    # crossings sorted along each scanline: inside intervals are between crossings 2i and 2i+1.
+    # Scanlines with an odd number of crossings (open contours) are skipped
+    order = np.lexsort((x, line))
+    line, x = line[order], x[order]
+    per_line = np.unique(line, return_counts=True)[1]
+    even = np.repeat(per_line % 2 == 0, per_line)
+    line, x = line[even], x[even]
+    x0, x1, line = x[0::2] + margin, x[1::2] - margin, line[0::2]
+    inside = x0 < x1
+    x0, x1, line = x0[inside], x1[inside], line[inside]
+    backwards = line % 2 == 1
+    x0, x1 = np.where(backwards, x1, x0), np.where(backwards, x0, x1)
+    order = np.lexsort((np.where(backwards, -x0, x0), line))
+    x0, x1, y = x0[order], x1[order], line[order] * spacing
+    segments = np.stack([np.stack([x0, y], axis=1), np.stack([x1, y], axis=1)], axis=1)
+    # back to the layer coordinates
+    return segments @ rotation
+
+# streams the perimeters and the infill of each layer as G-code, as the layers are produced. Lines are buffered and written in
+# blocks, and only the current layer is held in memory, so the output size does not depend on the part height.
+# Coordinates are in the model units (mm), feeds in mm/min and the extruder is absolute (M82)
+class GcodeWriter:
+    def __init__(self, file, extrusion_width: float = 0.4, filament_diameter: float = 1.75, print_feed: float = 1800,
+                 travel_feed: float = 6000, first_layer_height: float = 0.2, optimize_travel: bool = True,
+                 infill_density: float = 0.0, infill_angle: float = pi / 4, min_z: float = 0.0, buffer_lines: int = 4096):
+        self.file = file
+        self.extrusion_width = extrusion_width
+        self.filament_area = pi * (filament_diameter / 2) ** 2
+        self.print_feed = print_feed
+        self.travel_feed = travel_feed
+        self.first_layer_height = first_layer_height
+        self.optimize_travel = optimize_travel
+        # the bottom of the model rests on the bed, layers are raised by -min_z
+        self.min_z = min_z
+        # fraction of the area covered by infill (0 for none). Its direction turns by 90 degrees on every layer
+        self.infill_density = infill_density
+        self.infill_angle = infill_angle
+        self.layer_count = 0
+        self.buffer_lines = buffer_lines
+        self.buffer: list[str] = []
+        # lines written, and time spent producing them
+        self.lines = 0
+        self.elapsed = 0.0
+        self.extruded = 0.0
+        self.travel = 0.0
+        self.position = np.zeros(2)
+        self.previous_z: float | None = None
+
+    def emit(self, *lines: str):
+        self.buffer.extend(lines)
+        if len(self.buffer) >= self.buffer_lines:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0: return
+        self.file.write("\n".join(self.buffer) + "\n")
+        self.lines += len(self.buffer)
+        self.buffer.clear()
+
+    def start(self):
+        self.emit("; extrusion width {}, infill density {}".format(self.extrusion_width, self.infill_density), "G21", "G90", "M82", "G92 E0")
+
+    def finish(self):
+        self.emit("M84")
+        self.flush()
+
+    def write_layer(self, layer: Layer):
+        start = time.perf_counter()
+        height = self.first_layer_height if self.previous_z is None else layer.z - self.previous_z
+        self.previous_z = layer.z
+        # mm of filament per mm of perimeter
+        ratio = self.extrusion_width * height / self.filament_area
+        # the nozzle goes to the top of the layer: the first one, cut at min_z, is printed at first_layer_height and
+        # every next one is higher by the distance between the cuts, the height it is extruded with
+        top = layer.z - self.min_z + self.first_layer_height
+        self.emit(";LAYER {}".format(layer.z), "G0 Z{:.3f} F{:.0f}".format(top, self.travel_feed))
+        for loop in self.order([surface.points for surface in layer.surfaces]):
+            # back to the first point to close the loop
+            path = np.vstack([loop, loop[:1]])
+            lengths = np.hypot(*(path[1:] - path[:-1]).T)
+            extrusion = self.extruded + np.cumsum(lengths) * ratio
+            moves = ["G1 X{:.3f} Y{:.3f} E{:.5f}".format(x, y, e) for (x, y), e in zip(path[1:].tolist(), extrusion.tolist())]
+            # the feed is modal: the first extrusion move switches back from the travel feed
+            moves[0] += " F{:.0f}".format(self.print_feed)
+            self.emit("G0 X{:.3f} Y{:.3f} F{:.0f}".format(path[0, 0], path[0, 1], self.travel_feed), *moves)
+            self.extruded = float(extrusion[-1])
+            self.travel += float(np.hypot(*(path[0] - self.position)))
+            self.position = path[0]
+        if self.infill_density > 0:
+            angle = self.infill_angle + (pi / 2 if self.layer_count % 2 else 0)
+            self.write_infill(scanline_infill(layer.surfaces, self.extrusion_width / self.infill_density, angle, self.extrusion_width / 2), ratio)
+        self.layer_count += 1
+        self.elapsed += time.perf_counter() - start
+
+    # one extrusion per infill segment, in the zigzag order of scanline_infill
+    def write_infill(self, segments: np.ndarray, ratio: float):
+        if len(segments) == 0: return
+        extrusion = self.extruded + np.cumsum(np.hypot(*(segments[:, 1] - segments[:, 0]).T)) * ratio
+        self.emit(";INFILL")
+        for (start, end), e in zip(segments.tolist(), extrusion.tolist()):
+            self.emit("G0 X{:.3f} Y{:.3f} F{:.0f}".format(start[0], start[1], self.travel_feed), "G1 X{:.3f} Y{:.3f} E{:.5f} F{:.0f}".format(end[0], end[1], e, self.print_feed))
+        self.travel += float(np.hypot(*(segments[0, 0] - self.position))) + float(np.hypot(*(segments[1:, 0] - segments[:-1, 1]).T).sum())
+        self.extruded = float(extrusion[-1])
+        self.position = segments[-1, 1]
+
+    # (n, 2) arrays of the loops in printing order. With optimize_travel each loop is the one with the vertex nearest
+    # to the current position, and it starts from that vertex
+    def order(self, loops: list[tuple[Point, ...]]) -> list[np.ndarray]:
+        loops = [np.array([(p.x, p.y) for p in points]) for points in loops if len(points) > 1]
+        if not self.optimize_travel or len(loops) == 0:
+            return loops
+        points = np.concatenate(loops)
+        offsets = np.cumsum([0] + [len(loop) for loop in loops])
+        owner = np.repeat(np.arange(len(loops)), np.diff(offsets))
+        distance = np.empty(len(points))
+        done = np.zeros(len(points), dtype=bool)
+        position = self.position
+        ordered = []
+        for _ in loops:
+            np.hypot(*(points - position).T, out=distance)
+            distance[done] = np.inf
+            nearest = int(np.argmin(distance))
+            i = owner[nearest]
+            loop = np.roll(loops[i], offsets[i] - nearest, axis=0)
+            done[offsets[i]:offsets[i + 1]] = True
+            ordered.append(loop)
+            position = loop[0]
+        return ordered
+
+# each layer is drawn once, as a single Line3DCollection of its closed contours (holes in red). The z slider
+# only toggles the visibility of the layers it crossed since its last position. Past max_segments segments in
+# total, every n-th layer is drawn, then every n-th vertex of each contour, so the figure stays interactive.
+# matplotlib is only imported here, so batch runs never load the GUI stack
+def view_layers(layers: dict[float, list[Surface]], max_z: float, max_segments: int = 200000, show: bool = True):
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+    levels = sorted(layers.keys())
+    total = sum(len(surface.points) for z in levels for surface in layers[z])
+    layer_stride = min(max(-(-total // max_segments), 1), max(len(levels), 1))
+    levels = levels[::layer_stride]
+    kept = sum(len(surface.points) for z in levels for surface in layers[z])
+    vertex_stride = max(-(-kept // max_segments), 1)
+    if layer_stride > 1 or vertex_stride > 1:
+        logger.info("Drawing every {} layers and every {} vertices of {} segments".format(layer_stride, vertex_stride, total))
+
+    figure = plt.figure(figsize=(10, 10))
+    ax = figure.add_subplot(projection='3d')
+    # the layers with something to draw, and their collections
+    drawn = []
+    collections = []
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for z in levels:
+        loops = []
+        colors = []
+        for surface in layers[z]:
+            points = np.array([(p.x, p.y, p.z) for p in surface.points])[::vertex_stride]
+            if len(points) < 2: continue
+            loops.append(np.vstack([points, points[:1]]))
+            colors.append("tab:blue" if surface.fill else "tab:red")
+            low = np.minimum(low, points.min(axis=0))
+            high = np.maximum(high, points.max(axis=0))
+        if len(loops) == 0: continue
+        lines = Line3DCollection(loops, colors=colors, linewidths=0.5)
+        lines.set_visible(z <= max_z)
+        ax.add_collection3d(lines, autolim=False)
+        drawn.append(z)
+        collections.append(lines)
+    if np.all(np.isfinite(low)):
+        ax.set_xlim(low[0], high[0])
+        ax.set_ylim(low[1], high[1])
+        ax.set_zlim(low[2], high[2])
+        ax.set_box_aspect(np.maximum(high - low, 1e-9))
+
+    # number of layers currently visible, from the bottom
+    shown = bisect.bisect_right(drawn, max_z)
+
+    def update_chart(val):
+        nonlocal shown
+        count = bisect.bisect_right(drawn, val)
+        for lines in collections[min(shown, count):max(shown, count)]:
+            lines.set_visible(count > shown)
+        shown = count
+        figure.canvas.draw_idle()
+
+    bottom = levels[0] if levels else 0
+    slider = Slider(figure.add_axes([0.15, 0.03, 0.7, 0.03]), "z", bottom, max(max_z, bottom + 10**-DECIMALS), valinit=max_z)
+    slider.on_changed(update_chart)
+    if show:
+        plt.show()
+    return figure, slider, collections
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Slice an STL model into layers")
+    parser.add_argument("filename", help="STL file to slice (binary or ASCII)")
+    parser.add_argument("--step", type=float, default=0.05, help="layer height (default: %(default)s)")
+    parser.add_argument("--z-min", type=float, help="lowest layer to slice (default: bottom of the model)")
+    parser.add_argument("--z-max", type=float, help="highest layer to slice (default: top of the model)")
+    parser.add_argument("--adaptive", action="store_true", help="vary the layer height with the slope of the surface instead of using --step")
+    parser.add_argument("--min-height", type=float, default=0.025, help="thinnest adaptive layer (default: %(default)s)")
+    parser.add_argument("--max-height", type=float, default=0.2, help="thickest adaptive layer (default: %(default)s)")
+    parser.add_argument("--cusp", type=float, default=0.025, help="largest step left on sloped surfaces by adaptive layers (default: %(default)s)")
+    parser.add_argument("--simplify", type=float, default=0.0, metavar="TOL", help="drop the contour vertices closer than TOL to the simplified outline, keeping those needed so that no contour crosses another (default: %(default)s, off)")
+    parser.add_argument("--engine", choices=ENGINES, default="segments", help="slicing engine (default: %(default)s)")
+    parser.add_argument("--fixed-point", action="store_true", help="slice on integer coordinates (10^-{} units) instead of floats".format(DECIMALS))
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes slicing the layers")
+    parser.add_argument("--cache-dir", help="cache the parsed mesh and the layers in this directory")
+    parser.add_argument("--cache-size", type=int, default=512, help="maximum size of the cache in MB (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write the layers to this file, one JSON object per line")
+    parser.add_argument("--gcode", help="write the perimeters of the layers to this G-code file")
+    parser.add_argument("--extrusion-width", type=float, default=0.4, help="G-code extrusion width in mm (default: %(default)s)")
+    parser.add_argument("--filament-diameter", type=float, default=1.75, help="G-code filament diameter in mm (default: %(default)s)")
+    parser.add_argument("--print-feed", type=float, default=1800, help="G-code feed rate of the perimeters in mm/min (default: %(default)s)")
+    parser.add_argument("--travel-feed", type=float, default=6000, help="G-code feed rate of the travel moves in mm/min (default: %(default)s)")
+    parser.add_argument("--infill", type=float, default=0.0, help="G-code infill density between 0 and 1 (default: %(default)s, no infill)")
+    parser.add_argument("--infill-angle", type=float, default=45, help="G-code infill direction in degrees, turned by 90 on every layer (default: %(default)s)")
+    parser.add_argument("--no-travel-optimization", dest="optimize_travel", action="store_false", help="print the contours in slicing order instead of nearest first")
+    parser.add_argument("--headless", action="store_true", help="do not open the viewer")
+    parser.add_argument("--metrics", metavar="FILE", help="write the stage timers, counters and histograms of the run to FILE (- for stdout)")
+    parser.add_argument("--metrics-format", choices=("json", "prometheus"), default="json", help="format of --metrics (default: %(default)s)")
+    parser.add_argument("--profile", metavar="FILE", help="run under cProfile and save the stats to FILE")
+    parser.add_argument("--tracemalloc", action="store_true", help="trace the memory allocations and log the peak and the largest sites")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every layer")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    return parser.parse_args(argv)
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    level = logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=level, format="%(message)s")
+    metrics.reset()
+    metrics.enabled = args.metrics is not None
+    profile = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start()
+    if profile is not None:
+        profile.enable()
+    try:
+        run(args)
+    finally:
+        if profile is not None:
+            profile.disable()
+        # the snapshot is taken before the reports below allocate anything
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            metrics.gauge("peak_memory_bytes", peak)
+            logger.info("Peak traced memory {:.1f} MB, largest allocation sites:".format(peak / 1e6))
+            for stat in snapshot.statistics("lineno")[:10]:
+                logger.info("  {}".format(stat))
+        if profile is not None:
+            profile.dump_stats(args.profile)
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(15)
+            logger.info(text.getvalue())
+        if metrics.enabled:
+            text = metrics.to_json() if args.metrics_format == "json" else metrics.to_prometheus()
+            if args.metrics == "-":
+                sys.stdout.write(text)
+            else:
+                with open(args.metrics, mode='w') as file:
+                    file.write(text)
+            metrics.enabled = False
+
+def run(args: argparse.Namespace):
+    filename = args.filename
+    start = time.perf_counter()
+    cache = SliceCache(args.cache_dir, args.cache_size << 20) if args.cache_dir else None
+    with metrics.timer("parse"):
+        if cache is not None:
+            mesh, key = cache.load_mesh(filename)
+        else:
+            mesh = load_mesh(filename)
+    metrics.count("triangles", len(mesh.faces))
+    elapsed = time.perf_counter() - start
+    logger.info("Parsed {} triangles in {:.3f}s ({:.1f} MB/s)".format(len(mesh.faces), elapsed, os.path.getsize(filename) / 1e6 / max(elapsed, 1e-9)))
+    logger.info("Mesh has {} unique vertices ({} bytes)".format(len(mesh.vertices), mesh.nbytes))
+    min_z, max_z = mesh.z_bounds()
+    z_range = None
+    if args.z_min is not None or args.z_max is not None:
+        z_range = (min_z if args.z_min is None else args.z_min, max_z if args.z_max is None else args.z_max)
+
+    # the layers are only kept in memory when the viewer needs them
+    layers: dict[float, list[Surface]] = dict()
+    output = open(args.output, mode='w') if args.output else None
+    gcode = None
+    try:
+        count = 0
+        # contour vertices before and after --simplify
+        vertices = [0, 0]
+        with metrics.timer("levels"):
+            if args.adaptive:
+                levels = adaptive_levels(mesh, args.min_height, args.max_height, args.cusp, z_range)
+            else:
+                levels = mesh_levels(mesh, args.step, z_range)
+        if args.gcode:
+            first_layer_height = levels[1] - levels[0] if len(levels) > 1 else args.step
+            gcode = GcodeWriter(open(args.gcode, mode='w', buffering=1 << 20),
+                                extrusion_width=args.extrusion_width, filament_diameter=args.filament_diameter,
+                                print_feed=args.print_feed, travel_feed=args.travel_feed,
+                                first_layer_height=first_layer_height, optimize_travel=args.optimize_travel,
+                                infill_density=args.infill, infill_angle=args.infill_angle * pi / 180, min_z=min_z)
+            gcode.start()
+        if cache is not None:
+            sliced = cache.slice_layers(mesh, key, levels, args.engine, args.jobs, args.fixed_point)
+        else:
+            sliced = slice_layers(mesh, engine=args.engine, jobs=args.jobs, levels=levels, fixed_point=args.fixed_point)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for layer in metrics.timed(sliced, "slice"):
+            if count == 0:
+                logger.info("First layer after {:.3f}s".format(time.perf_counter() - start))
+            count += 1
+            metrics.count("layers")
+            if args.simplify > 0:
+                with metrics.timer("simplify"):
+                    before = sum(len(surface.points) for surface in layer.surfaces)
+                    layer = Layer(layer.z, simplify_surfaces(layer.surfaces, args.simplify))
+                    after = sum(len(surface.points) for surface in layer.surfaces)
+                vertices[0] += before
+                vertices[1] += after
+                metrics.count("vertices_removed", before - after)
+                if debug:
+                    logger.debug("Layer {}: {} -> {} vertices ({:.1%} removed)".format(layer.z, before, after, 1 - after / max(before, 1)))
+            if debug:
+                logger.debug("Layer {}: {} polygons {}".format(layer.z, len(layer.surfaces), [(len(surf.points), surf.fill) for surf in layer.surfaces]))
+            if output is not None:
+                with metrics.timer("output"):
+                    write_layer(output, layer)
+            if gcode is not None:
+                with metrics.timer("gcode"):
+                    gcode.write_layer(layer)
+            if not args.headless:
+                layers[layer.z] = layer.surfaces
+        if gcode is not None:
+            gcode.finish()
+            metrics.count("gcode_lines", gcode.lines)
+    finally:
+        if output is not None:
+            output.close()
+        if gcode is not None:
+            gcode.file.close()
+    logger.info("Sliced {} layers in {:.3f}s".format(count, time.perf_counter() - start))
+    if args.simplify > 0:
+        logger.info("Simplified {} -> {} vertices ({:.1%} removed)".format(vertices[0], vertices[1], 1 - vertices[1] / max(vertices[0], 1)))
+    if gcode is not None:
+        logger.info("Wrote {} G-code lines in {:.3f}s ({:.0f} lines/s), {:.1f} mm of travel".format(gcode.lines, gcode.elapsed, gcode.lines / max(gcode.elapsed, 1e-9), gcode.travel))
+    if cache is not None:
+        logger.info("{} layers read from the cache".format(count - cache.sliced_layers))
+
+    if not args.headless:
+        with metrics.timer("view"):
+            view_layers(layers, max_z)
 
-if __name__ == "main":
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
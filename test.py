@@ -1,7 +1,29 @@
 import unittest
-from main import intersect_segment_plane, intersect_polygon_plane, check_consecutive, check_parallel, Segment, Point, Polygon, surfaces_from_segments, parse_stl, angle_between_segments
+import inspect
+import json
+import subprocess
+import sys
+import os
+import tempfile
+import io
+import numpy as np
+from main import intersect_segment_plane, intersect_polygon_plane, check_consecutive, check_parallel, Segment, Point, Polygon, surfaces_from_segments, parse_stl, angle_between_segments, global_round
+import main as slicer
+import bench
+from main import load_stl, is_binary_stl, STL_BINARY_DTYPE, Mesh, load_mesh, TriangleIndex, layer_levels, intersect_triangles_plane, sweep_segments, segments_from_array, round_array, unique_segments
+from main import MeshTopology, trace_contours, Slicer, slice_parallel, slice_layers, slice_model, Layer
+from main import main as slicer_main, SliceCache, mesh_levels, to_fixed, Surface, RangeMax, adaptive_levels, GcodeWriter, scanline_infill, contour_tree, contour_parents, IntervalStabbing, simplify_loops, simplify_surfaces, Metrics
 from math import pi
 
+def write_binary_stl(filename, vertices, normals):
+    data = np.zeros(len(vertices), dtype=STL_BINARY_DTYPE)
+    data['vertices'] = vertices
+    data['normal'] = normals
+    with open(filename, mode='wb') as file:
+        file.write(b'solid binary'.ljust(80, b' '))
+        file.write(np.uint32(len(vertices)).tobytes())
+        file.write(data.tobytes())
+
 class TestGeometry(unittest.TestCase):
 
     def test_intersect_segment_plane_1(self):
@@ -224,6 +246,515 @@ class TestGeometry(unittest.TestCase):
 
         self.assertFalse(surf.fill)
     
+    def test_load_binary_stl(self):
+        vertices, normals = load_stl("examples/holed_cube.stl")
+        self.assertFalse(is_binary_stl("examples/holed_cube.stl"))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "holed_cube.stl")
+            write_binary_stl(filename, vertices, normals)
+            self.assertTrue(is_binary_stl(filename))
+            binary_vertices, binary_normals = load_stl(filename)
+            self.assertEqual(binary_vertices.shape, (32, 3, 3))
+            self.assertEqual(binary_normals.shape, (32, 3))
+            self.assertTrue(np.array_equal(binary_vertices, vertices))
+            self.assertTrue(np.array_equal(binary_normals, normals))
+            polygons = parse_stl(filename)
+            self.assertEqual(len(polygons), 32)
+            self.assertEqual(polygons[0].points[0], Point(*vertices[0][0]))
+
+    def test_load_ascii_stl_numbers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "numbers.stl")
+            with open(filename, mode='w') as file:
+                file.write("solid part 42\n facet normal 0 0 1\n  outer loop\n   vertex 1e-05 0 0\n   vertex 1 +2.5E0 -3\n   vertex 0.5 1 0\n  endloop\n endfacet\nendsolid part 42\n")
+            vertices, normals = load_stl(filename)
+        self.assertTrue(np.array_equal(normals, [[0, 0, 1]]))
+        self.assertTrue(np.array_equal(vertices, [[[0.00001, 0, 0], [1, 2.5, -3], [0.5, 1, 0]]]))
+
+    def test_load_ascii_stl_chunks(self):
+        vertices, normals = load_stl("examples/example8.stl")
+        chunk_size = slicer.STL_ASCII_CHUNK_SIZE
+        slicer.STL_ASCII_CHUNK_SIZE = 1000
+        try:
+            chunked_vertices, chunked_normals = load_stl("examples/example8.stl")
+        finally:
+            slicer.STL_ASCII_CHUNK_SIZE = chunk_size
+        self.assertEqual(vertices.shape, (660, 3, 3))
+        self.assertTrue(np.array_equal(chunked_vertices, vertices))
+        self.assertTrue(np.array_equal(chunked_normals, normals))
+
+    def test_mesh_welding(self):
+        triangles, normals = load_stl("examples/cube.stl")
+        mesh = Mesh.from_triangles(triangles, normals)
+        self.assertEqual(mesh.vertices.shape, (8, 3))
+        self.assertEqual(mesh.faces.shape, (12, 3))
+        self.assertEqual(mesh.faces.dtype, np.int32)
+        self.assertTrue(np.array_equal(mesh.triangles(), triangles))
+        self.assertTrue(np.array_equal(mesh.normals, normals))
+        self.assertEqual(mesh.z_bounds(), (-1.0, 1.0))
+
+    def test_mesh_polygons(self):
+        mesh = load_mesh("examples/holed_cube.stl")
+        polygons = mesh.polygons()
+        self.assertEqual(len(polygons), 32)
+        for polygon, expected in zip(polygons, parse_stl("examples/holed_cube.stl")):
+            self.assertEqual(polygon.points, expected.points)
+            self.assertEqual(polygon.normal, expected.normal)
+
+    def test_triangle_index(self):
+        mesh = load_mesh("examples/example1.stl")
+        polygons = mesh.polygons()
+        min_z, max_z = mesh.z_bounds()
+        index = TriangleIndex(mesh)
+        levels = layer_levels(min_z, max_z, 0.1)
+        swept = 0
+        for z, faces in index.sweep(levels):
+            expected = [s for p in polygons for s in intersect_polygon_plane(p, z)]
+            found = [s for face in faces for s in intersect_polygon_plane(polygons[face], z)]
+            self.assertEqual(found, expected)
+            self.assertLess(len(faces), len(polygons))
+            swept += 1
+        self.assertEqual(swept, len(levels))
+
+    def test_triangle_index_order(self):
+        index = TriangleIndex(load_mesh("examples/cube.stl"))
+        with self.assertRaises(Exception):
+            list(index.sweep([0.5, 0]))
+
+    def test_intersect_triangles_plane(self):
+        polygons = [
+            Polygon([Point(1,0,0), Point(1,1,0), Point(0,1,0)]),
+            Polygon([Point(1,0,0), Point(1,1,0), Point(1,1,1)], Point(1,0,0)),
+            Polygon([Point(1,0,0), Point(1,1,0), Point(0,0,1)], Point(1,0,0)),
+        ]
+        triangles = np.array([[[p.x, p.y, p.z] for p in polygon.points] for polygon in polygons], dtype=np.float64)
+        normals = np.array([[p.normal.x, p.normal.y, p.normal.z] for p in polygons], dtype=np.float64)
+        for z in [0, 0.5, 1]:
+            segments, rows = intersect_triangles_plane(triangles, z, normals)
+            expected = [s for p in polygons for s in intersect_polygon_plane(p, z)]
+            self.assertEqual(segments.shape, (len(expected), 2, 3))
+            self.assertEqual(segments_from_array(segments, normals[rows]), expected)
+
+    def test_intersect_triangles_many_levels(self):
+        triangles = np.array([[[1,0,0], [1,1,0], [1,1,1]]] * 3, dtype=np.float64)
+        segments, rows = intersect_triangles_plane(triangles, np.array([0.25, 2, 0.75]))
+        self.assertEqual(rows.tolist(), [0, 2])
+        self.assertTrue(np.array_equal(segments[:, :, 2], [[0.25, 0.25], [0.75, 0.75]]))
+
+    def test_sweep_segments(self):
+        mesh = load_mesh("examples/example9.stl")
+        polygons = mesh.polygons()
+        min_z, max_z = mesh.z_bounds()
+        levels = layer_levels(min_z, max_z, 0.05)
+        layers = list(sweep_segments(mesh, TriangleIndex(mesh), levels, batch_size=100))
+        self.assertEqual([z for z, _, _ in layers], levels)
+        for z, segments, faces in layers:
+            expected = [s for p in polygons for s in intersect_polygon_plane(p, z)]
+            found = segments_from_array(segments, mesh.normals[faces])
+            self.assertEqual([(s.p, s.q, s.normal) for s in found], [(s.p, s.q, s.normal) for s in expected])
+
+    def test_round_array(self):
+        values = np.array([0.1390145, -0.5499995, 1.0000005, 2.5e-7, 3.14159265])
+        self.assertEqual(round_array(values).tolist(), [global_round(v) for v in values.tolist()])
+
+    def test_hashable_geometry(self):
+        s = Segment(Point(0,0,0), Point(1,0,0))
+        self.assertEqual(len({s, Segment(Point(1,0,0), Point(0,0,0), Point(0,1,0)), Segment(Point(1,0,0), Point(2,0,0))}), 2)
+        self.assertFalse(s != Segment(Point(1,0,0), Point(0,0,0)))
+        self.assertEqual(len({Point(1,0,0), Point(1.0,0.0,0.0)}), 1)
+        with self.assertRaises(AttributeError):
+            s.p = Point(2,0,0)
+        self.assertEqual(Surface((Point(0,0,0),), True), Surface((Point(0,0,0),), True))
+        self.assertNotEqual(s, None)
+        self.assertFalse(s == (Point(0,0,0), Point(1,0,0), Point(0,0,0)))
+        self.assertFalse((Point(0,0,0), Point(1,0,0), Point(0,0,0)) == s)
+        self.assertTrue(s != tuple(s))
+        with self.assertRaises(TypeError):
+            sorted([s, Segment(Point(1,0,0), Point(0,0,0))])
+
+    def test_hashable_geometry_from_lists(self):
+        polygon = Polygon([Point(0,0,0), Point(1,0,0), Point(0,1,0)])
+        self.assertEqual(hash(polygon), hash(Polygon((Point(0,0,0), Point(1,0,0), Point(0,1,0)))))
+        self.assertIsInstance(polygon.points, tuple)
+        self.assertEqual(len({Surface([Point(0,0,0)], True), Surface((Point(0,0,0),), True)}), 1)
+
+    def test_unique_segments(self):
+        s1 = Segment(Point(0,0,0), Point(1,0,0))
+        s2 = Segment(Point(1,0,0), Point(1,1,0))
+        segments = unique_segments([s1, s2, Segment(Point(1,0,0), Point(0,0,0)), s1])
+        self.assertEqual(len(segments), 2)
+        self.assertIs(segments[0], s1)
+        self.assertIs(segments[1], s2)
+
+    def test_surfaces_from_segments_chain(self):
+        segments = [
+            Segment(Point(2,2,0), Point(0,2,0)),
+            Segment(Point(0,0,0), Point(1,0,0)),
+            Segment(Point(2,0,0), Point(2,2,0)),
+            Segment(Point(0,2,0), Point(0,0,0)),
+            Segment(Point(1,0,0), Point(2,0,0)),
+        ]
+        surfaces = surfaces_from_segments(segments)
+        self.assertEqual(len(surfaces), 1)
+        self.assertEqual(len(surfaces[0].points), 4)
+
+    def test_surfaces_from_segments_invalid(self):
+        segments = [
+            Segment(Point(0,0,0), Point(1,0,0)),
+            Segment(Point(1,0,0), Point(1,1,0)),
+            Segment(Point(1,0,0), Point(2,1,0)),
+        ]
+        with self.assertRaises(Exception):
+            surfaces_from_segments(segments)
+
+    def test_trace_contours(self):
+        mesh = load_mesh("examples/holed_cube.stl")
+        surfaces = trace_contours(MeshTopology(mesh), 0)
+        self.assertEqual(len(surfaces), 2)
+        outer, hole = sorted(surfaces, key=lambda s: -abs(s.points[0].x))
+        self.assertEqual(len(outer.points), 4)
+        self.assertEqual({(p.x, p.y) for p in outer.points}, {(-1,1), (1,1), (1,-1), (-1,-1)})
+        self.assertTrue(outer.fill)
+        self.assertEqual(len(hole.points), 4)
+        self.assertEqual({(p.x, p.y) for p in hole.points}, {(-0.278029,0.278029), (0.278029,0.278029), (0.278029,-0.278029), (-0.278029,-0.278029)})
+        self.assertFalse(hole.fill)
+
+    def test_trace_contours_vertex_on_plane(self):
+        # the cube has vertices at z=-1, the bottom face outline is found once, without repeated points
+        mesh = load_mesh("examples/cube.stl")
+        surfaces = trace_contours(MeshTopology(mesh), -1)
+        self.assertEqual(len(surfaces), 1)
+        self.assertEqual(len(surfaces[0].points), 4)
+        self.assertEqual(trace_contours(MeshTopology(mesh), 1), [])
+
+    def test_topology_slicer(self):
+        mesh = load_mesh("examples/example6.stl")
+        min_z, max_z = mesh.z_bounds()
+        levels = layer_levels(min_z, max_z, 0.1)
+        topology = MeshTopology(mesh)
+        for z, surfaces in Slicer(mesh, "topology").slice(levels):
+            expected = trace_contours(topology, z)
+            self.assertEqual([s.points for s in surfaces], [s.points for s in expected])
+
+    def test_slice_parallel(self):
+        mesh = load_mesh("examples/example9.stl")
+        min_z, max_z = mesh.z_bounds()
+        levels = layer_levels(min_z, max_z, 0.05)
+        for engine in ["segments", "topology"]:
+            expected = list(Slicer(mesh, engine).slice(levels))
+            layers = list(slice_parallel(mesh, levels, 2, engine))
+            self.assertEqual([z for z, _ in layers], levels)
+            for (_, surfaces), (_, expected_surfaces) in zip(layers, expected):
+                self.assertEqual([s.points for s in surfaces], [s.points for s in expected_surfaces])
+                self.assertEqual([s.fill for s in surfaces], [s.fill for s in expected_surfaces])
+
+    def test_slicer_engine(self):
+        with self.assertRaises(Exception):
+            Slicer(load_mesh("examples/cube.stl"), "unknown")
+
+    def test_slice_layers(self):
+        mesh = load_mesh("examples/holed_cube.stl")
+        layers = slice_layers(mesh, 0.1, engine="topology")
+        self.assertTrue(inspect.isgenerator(layers))
+        first = next(layers)
+        self.assertIsInstance(first, Layer)
+        self.assertEqual(first.z, -1.0)
+        z, surfaces = next(layers)
+        self.assertEqual(z, -0.9)
+        self.assertEqual(len(surfaces), 2)
+        self.assertEqual([layer.z for layer in slice_layers(mesh, 0.1, z_range=(-0.25, 0.25))], [-0.2, -0.1, 0.0, 0.1, 0.2])
+
+    def test_fixed_point(self):
+        mesh = load_mesh("examples/holed_cube.stl")
+        self.assertEqual(mesh.to_fixed().vertices.dtype, np.int64)
+        self.assertEqual(to_fixed([0.1, -1.0000004]).tolist(), [100000, -1000000])
+        for engine in ("segments", "topology"):
+            for (z, surfaces), (fixed_z, fixed_surfaces) in zip(slice_layers(mesh, 0.25, engine="topology"), slice_layers(mesh, 0.25, engine=engine, fixed_point=True)):
+                self.assertEqual(z, fixed_z)
+                self.assertEqual(sorted(len(s.points) for s in surfaces), sorted(len(s.points) for s in fixed_surfaces))
+                for surface in fixed_surfaces:
+                    self.assertTrue(all(p.z == z for p in surface.points))
+        # workers slice the vertices quantized once by slice_parallel
+        fixed = mesh.to_fixed()
+        self.assertIs(Slicer(fixed, "topology", True, quantized=True).mesh, fixed)
+        levels = mesh_levels(mesh, 0.25)
+        for engine in ("segments", "topology"):
+            expected = list(Slicer(mesh, engine, True).slice(levels))
+            layers = list(slice_parallel(mesh, levels, 2, engine, fixed_point=True))
+            self.assertEqual([[s.points for s in surfaces] for _, surfaces in layers], [[s.points for s in surfaces] for _, surfaces in expected])
+
+    def test_parallel_fixed(self):
+        self.assertTrue(check_parallel(Segment(Point(0, 0, 0), Point(3, 6, 9)), Segment(Point(1, 1, 1), Point(2, 3, 4))))
+        self.assertFalse(check_parallel(Segment(Point(0, 0, 0), Point(3, 6, 9)), Segment(Point(1, 1, 1), Point(2, 3, 5))))
+
+    def test_range_max(self):
+        covered = RangeMax.cover(7, np.array([0, 2, 6]), np.array([3, 4, 6]), np.array([0.5, 0.8, 0.1]))
+        self.assertEqual(covered.tolist(), [0.5, 0.5, 0.8, 0.8, 0.8, 0.0, 0.1])
+        bins = RangeMax(covered)
+        self.assertEqual(bins.query(0, 1), 0.5)
+        self.assertEqual(bins.query(1, 6), 0.8)
+        self.assertEqual(bins.query(5, 5), 0.0)
+
+    def test_adaptive_levels(self):
+        # vertical walls and flat faces only: every layer has the maximum height
+        levels = adaptive_levels(load_mesh("examples/cube.stl"), 0.025, 0.2, 0.025)
+        self.assertEqual(len(levels), 10)
+        self.assertTrue(np.allclose(np.diff(levels), 0.2))
+        mesh = load_mesh("examples/example6.stl")
+        levels = adaptive_levels(mesh, 0.025, 0.2, 0.025)
+        heights = np.diff(levels)
+        self.assertLess(len(levels), len(mesh_levels(mesh, 0.05)))
+        self.assertTrue(np.all(heights >= 0.025 - 1e-6) and np.all(heights <= 0.2 + 1e-6))
+        self.assertLess(heights.min(), heights.max())
+        self.assertEqual(adaptive_levels(mesh, 0.025, 0.2, 0.025, z_range=(1, 2)), [z for z in levels if 1 <= z <= 2])
+
+    def test_slice_model(self):
+        mesh = load_mesh("examples/cube.stl")
+        layers = slice_model(mesh, 0.5, engine="topology")
+        self.assertEqual(list(layers.keys()), [-1.0, -0.5, 0.0, 0.5])
+        self.assertTrue(all(len(surfaces) == 1 for surfaces in layers.values()))
+
+    def test_cli_headless(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "layers.jsonl")
+            slicer_main(["examples/cube.stl", "--headless", "-q", "--step", "0.5", "--z-min", "-0.5", "-o", output])
+            with open(output) as file:
+                layers = [json.loads(line) for line in file]
+        self.assertEqual([layer["z"] for layer in layers], [-0.5, 0.0, 0.5])
+        self.assertEqual(len(layers[0]["surfaces"]), 1)
+        self.assertEqual(len(layers[0]["surfaces"][0]["points"]), 4)
+
+    def test_gcode_writer(self):
+        def square(x):
+            return Surface(tuple(Point(*p) for p in [(x, 0, 0), (x + 1, 0, 0), (x + 1, 1, 0), (x, 1, 0)]), True)
+        layer = Layer(0.0, [square(10), square(0)])
+        file = io.StringIO()
+        gcode = GcodeWriter(file, first_layer_height=0.2, buffer_lines=3)
+        gcode.start()
+        gcode.write_layer(layer)
+        gcode.finish()
+        lines = file.getvalue().splitlines()
+        self.assertEqual(gcode.lines, len(lines))
+        travels = [line for line in lines if line.startswith("G0 X")]
+        moves = [line for line in lines if line.startswith("G1 X")]
+        # the square at the origin is printed first, from its corner nearest to (0, 0)
+        self.assertEqual(travels, ["G0 X0.000 Y0.000 F6000", "G0 X10.000 Y0.000 F6000"])
+        self.assertEqual(len(moves), 8)
+        self.assertTrue(moves[3].startswith("G1 X0.000 Y0.000 "))
+        extrusion = [float(line.split("E")[1].split()[0]) for line in moves]
+        self.assertEqual(extrusion, sorted(extrusion))
+        self.assertAlmostEqual(extrusion[-1], 8 * 0.4 * 0.2 / (pi * 1.75**2 / 4), places=4)
+        self.assertAlmostEqual(gcode.travel, 10)
+        file = io.StringIO()
+        gcode = GcodeWriter(file, optimize_travel=False)
+        gcode.write_layer(layer)
+        # nothing is written until the buffer is full or flushed
+        self.assertEqual(file.getvalue(), "")
+        gcode.flush()
+        self.assertEqual(file.getvalue().splitlines()[2], "G0 X10.000 Y0.000 F6000")
+
+    def test_gcode_layer_heights(self):
+        for args in [["examples/cube.stl"], ["examples/example6.stl", "--adaptive"]]:
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "out.gcode")
+                slicer_main([*args, "--headless", "-q", "--gcode", filename, "--step", "0.1"])
+                with open(filename) as file:
+                    heights = [float(line.split()[1][1:]) for line in file if line.startswith("G0 Z")]
+            mesh = load_mesh(args[0])
+            levels = adaptive_levels(mesh, 0.025, 0.2, 0.025) if "--adaptive" in args else mesh_levels(mesh, 0.1)
+            self.assertAlmostEqual(heights[0], levels[1] - levels[0], places=3)
+            self.assertTrue(all(z > 0 for z in heights))
+            self.assertTrue(np.all(np.diff(heights) > 0))
+
+    def test_scanline_infill(self):
+        surfaces = slice_model(load_mesh("examples/holed_cube.stl"), 0.5, engine="topology")[0.0]
+        segments = scanline_infill(surfaces, 0.25)
+        # the scanlines through the hole are split in two
+        self.assertEqual(len(segments), 11)
+        self.assertEqual(segments[3].round(6).tolist(), [[1.0, -0.25], [0.278029, -0.25]])
+        self.assertEqual(segments[4].round(6).tolist(), [[-0.278029, -0.25], [-1.0, -0.25]])
+        # zigzag: each segment starts next to where the previous one ended, at most across the hole
+        self.assertLess(np.hypot(*(segments[1:, 0] - segments[:-1, 1]).T).max(), 0.6)
+        lengths = np.hypot(*(segments[:, 1] - segments[:, 0]).T)
+        self.assertAlmostEqual(lengths.sum(), 5 * 2 + 3 * 2 * (1 - 0.278029), places=5)
+        rotated = scanline_infill(surfaces, 0.25, pi / 2, margin=0.1)
+        self.assertTrue(np.allclose(rotated[:, 0, 0], rotated[:, 1, 0]))
+        self.assertTrue(np.all(np.abs(rotated) <= 0.9 + 1e-9))
+        self.assertEqual(scanline_infill([], 0.25).shape, (0, 2, 2))
+
+    def test_contour_tree(self):
+        def square(x, y, r):
+            return Surface(tuple(Point(x + dx * r, y + dy * r, 0) for dx, dy in [(-1, -1), (1, -1), (1, 1), (-1, 1)]), True)
+        # two parts, the first with a hole holding an island
+        surfaces = [square(0, 0, 0.5), square(10, 0, 1), square(0, 0, 3), square(0, 0, 1)]
+        roots = contour_tree(surfaces)
+        self.assertEqual([root.surface.points for root in roots], [surfaces[1].points, surfaces[2].points])
+        self.assertEqual(roots[1].children[0].surface.points, surfaces[3].points)
+        island = roots[1].children[0].children[0]
+        self.assertEqual((island.surface.points, island.depth, island.surface.fill), (surfaces[0].points, 2, True))
+        self.assertFalse(roots[1].children[0].surface.fill)
+        self.assertEqual(roots[0].children, [])
+        layer = next(slice_layers(load_mesh("examples/holed_cube.stl"), 0.5))
+        self.assertEqual([(node.depth, node.surface.fill, len(node.children)) for node in layer.tree], [(0, True, 1)])
+        self.assertFalse(layer.tree[0].children[0].surface.fill)
+
+    def test_contour_parents_column(self):
+        def square(x, y, r):
+            return tuple(Point(x + dx * r, y + dy * r, 0) for dx, dy in [(-1, -1), (1, -1), (1, 1), (-1, 1)])
+        # one x range shared by every contour: a column of 500 cells, each with a hole
+        loops = [square(0, 3 * k, r) for k in range(500) for r in (1, 0.5)]
+        parents, depth = contour_parents(loops)
+        self.assertEqual(parents.tolist(), [p for k in range(500) for p in (-1, 2 * k)])
+        self.assertEqual(depth.tolist(), [0, 1] * 500)
+
+    def test_interval_stabbing(self):
+        intervals = IntervalStabbing(10)
+        intervals.add(0, 0, 9)
+        intervals.add(1, 2, 4)
+        intervals.add(2, 4, 4)
+        self.assertEqual(sorted(intervals.stab(4)), [0, 1, 2])
+        self.assertEqual(sorted(intervals.stab(5)), [0])
+        intervals.remove(1, 2, 4)
+        self.assertEqual(sorted(intervals.stab(3)), [0])
+        self.assertEqual(IntervalStabbing(1).stab(0), [])
+
+    def test_simplify(self):
+        angles = np.linspace(0, 2 * pi, 1000, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles), np.zeros(1000)], axis=1)
+        square = np.array([[0, 0, 0], [1, 0, 0], [1, 0.5, 0], [1, 1, 0], [0, 1, 0]], dtype=float)
+        # smaller than the tolerance: kept whole rather than collapsed
+        tiny = np.array([[5, 5, 0], [5.001, 5, 0], [5, 5.001, 0]])
+        circle_simplified, square_simplified, tiny_simplified = simplify_loops([circle, square, tiny], 0.01)
+        self.assertEqual(square_simplified.tolist(), [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]])
+        self.assertTrue(np.array_equal(tiny_simplified, tiny))
+        self.assertLess(len(circle_simplified), 100)
+        # every dropped point is within the tolerance of the simplified outline: the vertices are on the circle, so
+        # the largest gap is the sagitta of the longest chord
+        gaps = np.diff(np.unwrap(np.arctan2(circle_simplified[:, 1], circle_simplified[:, 0])))
+        self.assertLessEqual(1 - np.cos(np.abs(gaps).max() / 2), 0.01)
+        layer = next(slice_layers(load_mesh("examples/holed_cube.stl"), 0.5))
+        simplified = simplify_surfaces(layer.surfaces, 0.01)
+        self.assertEqual([(s.points, s.fill) for s in simplified], [(s.points, s.fill) for s in layer.surfaces])
+        self.assertEqual(simplify_loops([circle], 0)[0].shape, circle.shape)
+
+    def test_simplify_topology(self):
+        # the dip of the outline is below the tolerance, but dropping it would let the hole cross the outline
+        outline = np.array([[0, 0, 0], [5, -0.008, 0], [10, 0, 0], [10, 10, 0], [0, 10, 0]])
+        hole = np.array([[4.9, 1, 0], [5.1, 1, 0], [5, -0.004, 0]])
+        self.assertEqual(len(simplify_loops([outline], 0.01)[0]), 4)
+        simplified, simplified_hole = simplify_loops([outline, hole], 0.01)
+        self.assertTrue(np.array_equal(simplified, outline))
+        self.assertTrue(np.array_equal(simplified_hole, hole))
+
+    def test_view_layers(self):
+        import matplotlib
+        matplotlib.use("Agg")
+        layers = slice_model(load_mesh("examples/holed_cube.stl"), 0.25)
+        figure, slider, collections = slicer.view_layers(layers, 0.0, show=False)
+        self.assertEqual(len(collections), 8)
+        self.assertEqual([lines.get_visible() for lines in collections], [True] * 5 + [False] * 3)
+        self.assertEqual(len(collections[0].get_segments()), 2)
+        slider.set_val(-0.5)
+        self.assertEqual(sum(lines.get_visible() for lines in collections), 3)
+        slider.set_val(1.0)
+        self.assertTrue(all(lines.get_visible() for lines in collections))
+        # 8 layers of 8 vertices above a budget of 16 segments: every 4th layer
+        figure, slider, collections = slicer.view_layers(layers, 1.0, max_segments=16, show=False)
+        self.assertEqual(len(collections), 2)
+        import matplotlib.pyplot as plt
+        plt.close("all")
+
+    def test_bench(self):
+        self.assertEqual(bench.sphere(1).shape, (80, 3, 3))
+        lattice = Mesh.from_triangles(bench.lattice(2), np.zeros((96, 3)))
+        self.assertEqual((len(lattice.faces), len(lattice.vertices)), (96, 64))
+        results = bench.run(["examples/cube.stl"], [], 0.5, 1, io.StringIO())
+        stages = results["models"]["cube.stl"]["stages"]
+        self.assertEqual(list(stages), ["parse_stl", "load_mesh", "intersect", "surfaces", "pipeline"])
+        self.assertEqual(bench.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower["models"]["cube.stl"]["stages"]["pipeline"]["time"] += 1
+        self.assertEqual([(model, stage) for model, stage, _ in bench.compare(slower, results)], [("cube.stl", "pipeline")])
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.count("layers")
+        metrics.observe("segments_per_layer", 3)
+        with metrics.timer("slice"):
+            pass
+        metrics.gauge("peak_memory_bytes", 10)
+        self.assertEqual(metrics.state(), {"timers": {}, "counters": {}, "gauges": {}, "histograms": {}})
+        metrics.enabled = True
+        metrics.count("layers", 2)
+        metrics.gauge("peak_memory_bytes", 10)
+        metrics.gauge("peak_memory_bytes", 7)
+        for value in (3, 3, 40000, 10**6):
+            metrics.observe("segments_per_layer", value)
+        with metrics.timer("slice"):
+            pass
+        self.assertEqual(list(metrics.timed([1, 2], "slice")), [1, 2])
+        self.assertEqual(metrics.timers["slice"][0], 3)
+        exported = json.loads(metrics.to_json())
+        self.assertEqual(exported["counters"], {"layers": 2})
+        self.assertEqual(exported["gauges"], {"peak_memory_bytes": 7})
+        histogram = exported["histograms"]["segments_per_layer"]
+        self.assertEqual((histogram["buckets"]["5"], histogram["buckets"]["50000"], histogram["buckets"]["+Inf"], histogram["count"]), (2, 1, 1, 4))
+        text = metrics.to_prometheus()
+        self.assertIn('slicer_segments_per_layer_bucket{le="2"} 0\n', text)
+        self.assertIn('slicer_segments_per_layer_bucket{le="+Inf"} 4\n', text)
+        self.assertIn("slicer_layers_total 2\n", text)
+        self.assertIn("# TYPE slicer_peak_memory_bytes gauge\nslicer_peak_memory_bytes 7\n", text)
+        self.assertIn('slicer_stage_calls_total{stage="slice"} 3\n', text)
+        other = Metrics(True)
+        other.merge(metrics.state())
+        other.merge(metrics.state())
+        self.assertEqual(other.histograms["segments_per_layer"][-1], 8)
+        self.assertEqual(other.gauges, {"peak_memory_bytes": 7})
+
+    def test_cli_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "metrics.json")
+            slicer_main(["examples/holed_cube.stl", "--headless", "-q", "--step", "0.5", "--engine", "topology", "--metrics", output])
+            with open(output) as file:
+                exported = json.load(file)
+        self.assertEqual(exported["counters"]["layers"], 4)
+        self.assertEqual(exported["histograms"]["contours_per_layer"]["sum"], 8)
+        self.assertEqual(exported["timers"]["slice"]["calls"], 4)
+        self.assertFalse(slicer.metrics.enabled)
+
+    def test_no_gui_imports(self):
+        code = "import sys, main; print('vpython' in sys.modules or 'matplotlib' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_slice_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SliceCache(tmp)
+            mesh, key = cache.load_mesh("examples/holed_cube.stl")
+            cached_mesh, cached_key = cache.load_mesh("examples/holed_cube.stl")
+            self.assertEqual(cached_key, key)
+            self.assertTrue(np.array_equal(cached_mesh.faces, mesh.faces))
+            levels = mesh_levels(mesh, 0.1, (-0.5, 0.5))
+            layers = list(cache.slice_layers(mesh, key, levels, "topology"))
+            self.assertEqual(cache.sliced_layers, len(levels))
+            cached = list(cache.slice_layers(mesh, key, levels, "topology"))
+            self.assertEqual(cache.sliced_layers, 0)
+            self.assertEqual([[(s.points, s.fill) for s in surfaces] for _, surfaces in cached], [[(s.points, s.fill) for s in surfaces] for _, surfaces in layers])
+            # a wider range only slices the new levels
+            levels = mesh_levels(mesh, 0.1)
+            layers = list(cache.slice_layers(mesh, key, levels, "topology"))
+            self.assertEqual(cache.sliced_layers, len(levels) - 11)
+            self.assertEqual([z for z, _ in layers], levels)
+            expected = list(slice_layers(mesh, 0.1, engine="topology"))
+            for (_, surfaces), (_, expected_surfaces) in zip(layers, expected):
+                self.assertEqual([(s.points, s.fill) for s in surfaces], [(s.points, s.fill) for s in expected_surfaces])
+
+    def test_slice_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SliceCache(tmp, max_bytes=1)
+            cache.load_mesh("examples/cube.stl")
+            self.assertEqual(os.listdir(tmp), [])
+
     def test_angle_between_segments(self):
         s1 = Segment(Point(0,0,0), Point(1,0,0))
         s2 = Segment(Point(0,0,0), Point(1,1,0))